@@ -1,22 +1,50 @@
 """Agent implementations and shared interfaces."""
 
-from .types import AgentResult, TaskInstance
-from .base import Agent
-from .model import HFModel
-from .long_context import LongContextAgent
-from .rag import RAGAgent, RAGConfig
-from .summarization import SummarizationAgent, SummaryState
-from .sequenced import SequencedMultiAgent
-
-__all__ = [
-    "Agent",
-    "AgentResult",
-    "TaskInstance",
-    "HFModel",
-    "LongContextAgent",
-    "RAGAgent",
-    "RAGConfig",
-    "SummarizationAgent",
-    "SummaryState",
-    "SequencedMultiAgent",
-]
+from __future__ import annotations
+
+import importlib
+from typing import TYPE_CHECKING, Any
+
+# Submodules are imported on first attribute access (PEP 562) so that importing a
+# light helper such as agents.result_store does not pull in torch and faiss.
+_EXPORTS = {
+    "Agent": ".base",
+    "AgentResult": ".types",
+    "TaskInstance": ".types",
+    "HFModel": ".model",
+    "acquire_embedder": ".embedders",
+    "release_embedder": ".embedders",
+    "PrefixCache": ".prefix_cache",
+    "LongContextAgent": ".long_context",
+    "RAGAgent": ".rag",
+    "RAGConfig": ".rag",
+    "SummarizationAgent": ".summarization",
+    "SummaryState": ".summarization",
+    "SequencedMultiAgent": ".sequenced",
+}
+
+__all__ = list(_EXPORTS)
+
+if TYPE_CHECKING:
+    from .base import Agent
+    from .embedders import acquire_embedder, release_embedder
+    from .long_context import LongContextAgent
+    from .model import HFModel
+    from .prefix_cache import PrefixCache
+    from .rag import RAGAgent, RAGConfig
+    from .sequenced import SequencedMultiAgent
+    from .summarization import SummarizationAgent, SummaryState
+    from .types import AgentResult, TaskInstance
+
+
+def __getattr__(name: str) -> Any:
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
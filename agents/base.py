@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import Dict
+from typing import Any, Dict, List, Sequence
 
 from .types import AgentResult, TaskInstance
 
@@ -14,5 +14,19 @@ class Agent(ABC):
     def run(self, instance: TaskInstance) -> AgentResult:
         raise NotImplementedError
 
+    def run_batch(self, instances: Sequence[TaskInstance]) -> List[AgentResult]:
+        return [self.run(instance) for instance in instances]
+
+    # prepare() holds the work that does not need the generator (retrieval, prompt
+    # building) so a pipelined runner can do it ahead of run_prepared().
+    def prepare(self, instances: Sequence[TaskInstance]) -> List[Any]:
+        return list(instances)
+
+    def run_prepared(self, prepared: List[Any]) -> List[AgentResult]:
+        return self.run_batch(prepared)
+
+    def close(self) -> None:
+        pass
+
     def config(self) -> Dict[str, str]:
         return {"name": self.name}
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .utils import atomic_write_path
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    # Hyphenated keys such as "ALPHA-12" are indexed whole and by their parts.
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        if "-" in token:
+            tokens.extend(token.split("-"))
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 over an inverted index stored as CSR-style NumPy arrays.
+
+    Postings of term ``t`` are ``doc_rows[indptr[t]:indptr[t + 1]]`` with their
+    precomputed BM25 weights in ``weights``, so a query only touches the postings of
+    its own terms.
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        indptr: np.ndarray,
+        doc_rows: np.ndarray,
+        weights: np.ndarray,
+        passage_ids: np.ndarray,
+    ):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_rows = doc_rows
+        self.weights = weights
+        self.passage_ids = passage_ids
+
+    @classmethod
+    def build(
+        cls,
+        passages: Iterable[str],
+        passage_ids: Optional[Sequence[int]] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> "BM25Index":
+        vocab: Dict[str, int] = {}
+        term_buf = array("i")
+        row_buf = array("i")
+        tf_buf = array("f")
+        lengths = array("f")
+        for row, passage in enumerate(passages):
+            tokens = tokenize(passage)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_buf.append(vocab.setdefault(term, len(vocab)))
+                row_buf.append(row)
+                tf_buf.append(tf)
+
+        num_docs = len(lengths)
+        terms = np.frombuffer(term_buf, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")
+        doc_rows = np.frombuffer(row_buf, dtype=np.int32)[order]
+        tfs = np.frombuffer(tf_buf, dtype=np.float32)[order]
+        df = np.bincount(terms, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+
+        doc_len = np.frombuffer(lengths, dtype=np.float32)
+        avgdl = float(doc_len.mean()) if num_docs else 0.0
+        idf = np.log1p((num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1.0 - b + b * doc_len[doc_rows] / max(avgdl, 1e-9))
+        weights = np.repeat(idf, df) * tfs * (k1 + 1.0) / (tfs + norm)
+
+        if passage_ids is None:
+            passage_ids = np.arange(num_docs, dtype=np.int64)
+        return cls(vocab, indptr, doc_rows, weights.astype(np.float32), np.asarray(passage_ids, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.passage_ids)
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        rows = []
+        weights = []
+        for term, qtf in Counter(tokenize(query)).items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            rows.append(self.doc_rows[start:end])
+            weights.append(self.weights[start:end] * qtf)
+        if not rows:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        unique_rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        # np.unique already sorted the candidates, so a full sort costs no more in
+        # big-O terms and gives a stable tie-break on row order.
+        top = np.lexsort((unique_rows, -scores))[:k]
+        return scores[top], self.passage_ids[unique_rows[top]]
+
+    def search_batch(self, queries: Sequence[str], k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [self.search(query, k) for query in queries]
+
+    def save(self, prefix: Path) -> None:
+        arrays_path = prefix.with_name(prefix.name + ".bm25.npz")
+        vocab_path = prefix.with_name(prefix.name + ".bm25.vocab.json")
+        terms = sorted(self.vocab, key=self.vocab.get)
+        with atomic_write_path(vocab_path) as tmp_vocab:
+            tmp_vocab.write_text(json.dumps(terms), encoding="utf-8")
+        # np.savez appends ".npz" to names without it, so the temporary name keeps it.
+        with atomic_write_path(arrays_path, suffix=".tmp.npz") as tmp_arrays:
+            np.savez(
+                tmp_arrays,
+                indptr=self.indptr,
+                doc_rows=self.doc_rows,
+                weights=self.weights,
+                passage_ids=self.passage_ids,
+            )
+
+    @classmethod
+    def load(cls, prefix: Path) -> Optional["BM25Index"]:
+        arrays_path = prefix.with_name(prefix.name + ".bm25.npz")
+        vocab_path = prefix.with_name(prefix.name + ".bm25.vocab.json")
+        if not (arrays_path.exists() and vocab_path.exists()):
+            return None
+        terms = json.loads(vocab_path.read_text(encoding="utf-8"))
+        with np.load(arrays_path) as data:
+            return cls(
+                {term: idx for idx, term in enumerate(terms)},
+                data["indptr"],
+                data["doc_rows"],
+                data["weights"],
+                data["passage_ids"],
+            )
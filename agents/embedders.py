@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+# Process-wide SentenceTransformer instances keyed by (model name, device), so the
+# RAG agents and the evaluation metrics share one copy of each set of weights.
+_EMBEDDERS: Dict[Tuple[str, str], SentenceTransformer] = {}
+_REFCOUNTS: Dict[Tuple[str, str], int] = {}
+_LOCK = threading.Lock()
+
+
+def resolve_device(use_gpu: bool = True) -> str:
+    import torch
+
+    return "cuda" if use_gpu and torch.cuda.is_available() else "cpu"
+
+
+def acquire_embedder(
+    model_name: str,
+    device: Optional[str] = None,
+    cache_folder: Optional[str] = None,
+    local_files_only: bool = False,
+) -> SentenceTransformer:
+    key = (model_name, device or resolve_device())
+    with _LOCK:
+        embedder = _EMBEDDERS.get(key)
+        if embedder is None:
+            from sentence_transformers import SentenceTransformer
+
+            print(f"Loading embedder: {model_name} (device={key[1]})")
+            embedder = SentenceTransformer(
+                model_name,
+                device=key[1],
+                cache_folder=cache_folder,
+                local_files_only=local_files_only,
+            )
+            _EMBEDDERS[key] = embedder
+        _REFCOUNTS[key] = _REFCOUNTS.get(key, 0) + 1
+        return embedder
+
+
+def release_embedder(model_name: str, device: Optional[str] = None) -> None:
+    key = (model_name, device or resolve_device())
+    with _LOCK:
+        count = _REFCOUNTS.get(key, 0) - 1
+        if count > 0:
+            _REFCOUNTS[key] = count
+            return
+        _REFCOUNTS.pop(key, None)
+        _EMBEDDERS.pop(key, None)
+
+
+@contextmanager
+def held_embedder(
+    model_name: str, device: Optional[str] = None, cache_folder: Optional[str] = None
+) -> Iterator[SentenceTransformer]:
+    """Hold a reference for the whole block so agents closed in between never unload it."""
+    embedder = acquire_embedder(model_name, device=device, cache_folder=cache_folder)
+    try:
+        yield embedder
+    finally:
+        release_embedder(model_name, device)
+
+
+def loaded_embedders() -> List[Tuple[str, str]]:
+    with _LOCK:
+        return list(_EMBEDDERS)
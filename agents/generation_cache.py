@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Optional
+
+# Bump when the shape or meaning of cached results changes so old entries are
+# no longer returned (2: text excludes the prompt, tokens_out counts generated ids).
+RESULT_VERSION = 2
+
+# Result keys that describe how a particular call ran rather than what it produced.
+_TRANSIENT_KEYS = (
+    "prefix_tokens_reused",
+    "prefix_cache_hit_rate",
+    "batch_size",
+    "cache_hit",
+    "spans_ns",
+    "prefill_tokens",
+    "decode_tokens",
+    "ttft_ms",
+    "inter_token_ms",
+    "stopped_early",
+)
+
+
+def is_cacheable(config: Any) -> bool:
+    return config.temperature <= 0 or getattr(config, "seed", None) is not None
+
+
+class GenerationCache:
+    """On-disk cache of generation results in a single SQLite file.
+
+    Entries are evicted least-recently-used once their stored size passes
+    ``max_bytes``. One connection is shared between threads behind a lock.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 1 << 30):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, nbytes INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS generations_lru ON generations (last_access)")
+        self._conn.commit()
+        self._nbytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM generations").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_id: str, quantization: str, prompt: str, config: Any) -> str:
+        payload = json.dumps(
+            {
+                "version": RESULT_VERSION,
+                "model_id": model_id,
+                "quantization": quantization,
+                "prompt": prompt,
+                "config": asdict(config),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM generations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE generations SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, result: dict) -> None:
+        payload = json.dumps({k: v for k, v in result.items() if k not in _TRANSIENT_KEYS})
+        nbytes = len(payload.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._conn.execute("SELECT nbytes FROM generations WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generations (key, result, nbytes, last_access) VALUES (?, ?, ?, ?)",
+                (key, payload, nbytes, time.time()),
+            )
+            self._nbytes += nbytes - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        while self._nbytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, nbytes FROM generations ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._nbytes = 0
+                return
+            for key, nbytes in rows:
+                if self._nbytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+                self._nbytes -= nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
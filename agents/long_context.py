@@ -1,24 +1,46 @@
 from __future__ import annotations
 
-from typing import Optional
+from typing import Callable, List, Optional, Sequence
 
 from .base import Agent
-from .model import HFModel, GenerationConfig
+from .model import HFModel, GenerationConfig, generation_metadata
 from .types import AgentResult, TaskInstance
+from .utils import Spans
 
 
 class LongContextAgent(Agent):
-    def __init__(self, model: HFModel, config: Optional[GenerationConfig] = None):
+    def __init__(
+        self,
+        model: HFModel,
+        config: Optional[GenerationConfig] = None,
+        stop: Optional[Callable[[str], bool]] = None,
+    ):
         super().__init__(name="long_context")
         self.model = model
         self.config = config
+        self.stop = stop
 
-    def run(self, instance: TaskInstance) -> AgentResult:
-        result = self.model.generate(instance.input, self.config)
+    def _to_result(self, result: dict, spans: Spans) -> AgentResult:
         return AgentResult(
             text=result["text"],
             tokens_in=result["tokens_in"],
             tokens_out=result["tokens_out"],
             latency_ms=result["latency_ms"],
-            metadata={"agent": self.name},
+            metadata={"agent": self.name, **generation_metadata(result), **spans.metadata()},
         )
+
+    def run(self, instance: TaskInstance) -> AgentResult:
+        spans = Spans()
+        with spans.span("total"):
+            result = self.model.generate(instance.input, self.config, stop=self.stop)
+        return self._to_result(result, spans.add_calls([result]))
+
+    def run_batch(self, instances: Sequence[TaskInstance]) -> List[AgentResult]:
+        if self.stop is not None:
+            # Early stopping streams, and streams decode one prompt at a time.
+            return [self.run(instance) for instance in instances]
+        spans = Spans()
+        with spans.span("total"):
+            results = self.model.generate_batch([inst.input for inst in instances], self.config)
+        spans.add_calls(results)
+        return [self._to_result(result, spans) for result in results]
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import copy
+import threading
+import time
 from dataclasses import dataclass
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Sequence
 
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from .generation_cache import GenerationCache, is_cacheable
+from .prefix_cache import PrefixCache
+from .utils import Spans, Timer
 
-from .utils import count_tokens, Timer
+if TYPE_CHECKING:
+    import torch
 
 
 @dataclass
@@ -14,12 +19,153 @@ class GenerationConfig:
     max_new_tokens: int = 512
     temperature: float = 0.2
     top_p: float = 0.95
+    seed: Optional[int] = None
+
+
+def generation_metadata(result: dict) -> dict:
+    metadata = {}
+    if "prefix_tokens_reused" in result:
+        metadata["prefill_tokens_saved"] = result["prefix_tokens_reused"]
+        metadata["prefix_cache_hit_rate"] = result["prefix_cache_hit_rate"]
+    for key in ("cache_hit", "ttft_ms", "inter_token_ms", "stopped_early"):
+        if key in result:
+            metadata[key] = result[key]
+    return metadata
+
+
+def stop_at(sequences: Sequence[str]) -> Callable[[str], bool]:
+    """Stream stop condition: end generation once any of ``sequences`` appears."""
+    return lambda text: any(sequence in text for sequence in sequences)
+
+
+def latency_profile(start_ns: int, step_ns: Sequence[int]) -> dict:
+    """Time to first token and the inter-token gap distribution, in milliseconds."""
+    if not step_ns:
+        return {}
+    gaps = sorted(b - a for a, b in zip(step_ns, step_ns[1:]))
+    profile: dict = {"ttft_ms": round((step_ns[0] - start_ns) / 1e6, 3)}
+    if gaps:
+        profile["inter_token_ms"] = {
+            "mean": round(sum(gaps) / len(gaps) / 1e6, 3),
+            "p50": round(gaps[len(gaps) // 2] / 1e6, 3),
+            "p90": round(gaps[min(len(gaps) - 1, int(len(gaps) * 0.9))] / 1e6, 3),
+            "max": round(gaps[-1] / 1e6, 3),
+        }
+    return profile
+
+
+class _StepClock:
+    """Logits processor that timestamps every forward pass of generate().
+
+    Processors run once per step right after the model call, so the first
+    timestamp marks the end of prefill and each later one a decoded token.
+    CUDA kernels run asynchronously, so on a GPU ``sync`` is called first to
+    stamp when the step's forward pass finished rather than when it was queued.
+    """
+
+    def __init__(self, sync: Optional[Callable[[], None]] = None):
+        self.sync = sync
+        self.steps: List[int] = []
+
+    def __call__(self, input_ids, scores):
+        if self.sync is not None:
+            self.sync()
+        self.steps.append(time.perf_counter_ns())
+        return scores
+
+
+class _EventStop:
+    """Stopping criterion that ends generation once ``event`` is set."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        stop = self.event.is_set()
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationStream:
+    """Text increments of one generation, yielded as the streamer decodes them.
+
+    Generation runs on a background thread. Once ``stop`` returns True for the
+    text received so far, or the caller abandons the loop, generation halts at
+    the next step. ``result`` holds the usual result dict when iteration ends.
+    """
+
+    def __init__(
+        self, run: Callable[[threading.Event], dict], streamer, stop: Optional[Callable[[str], bool]]
+    ):
+        self.text = ""
+        self.result: Optional[dict] = None
+        self._streamer = streamer
+        self._stop = stop
+        self._event = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._consumed = False
+        self._thread = threading.Thread(target=self._run, args=(run,), name="generate-stream", daemon=True)
+        self._thread.start()
+
+    def _run(self, run: Callable[[threading.Event], dict]) -> None:
+        try:
+            self.result = run(self._event)
+        except BaseException as exc:  # noqa: BLE001
+            self._error = exc
+            self._streamer.end()
+
+    def __iter__(self) -> Iterator[str]:
+        # The streamer can only be read once; later loops see an empty stream.
+        if self._consumed:
+            return
+        self._consumed = True
+        stopped = True
+        try:
+            for piece in self._streamer:
+                if not piece or self._event.is_set():
+                    continue
+                self.text += piece
+                yield piece
+                if self._stop is not None and self._stop(self.text):
+                    self._event.set()
+            stopped = self._event.is_set()
+        finally:
+            self._event.set()
+            self._thread.join()
+            if self.result is not None:
+                self.result["text"] = self.text
+                self.result["stopped_early"] = stopped
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"Model call failed: {self._error}") from self._error
+
+    def collect(self) -> dict:
+        for _ in self:
+            pass
+        self._raise_error()
+        return self.result
 
 
 class HFModel:
-    def __init__(self, model_id: str, load_in_4bit: bool = True):
+    def __init__(
+        self,
+        model_id: str,
+        load_in_4bit: bool = True,
+        prefix_cache: Optional[PrefixCache] = None,
+        generation_cache: Optional[GenerationCache] = None,
+    ):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
         self.model_id = model_id
+        self.prefix_cache = prefix_cache
+        self.generation_cache = generation_cache
         self.tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         use_cuda = torch.cuda.is_available()
         if load_in_4bit and not use_cuda:
             load_in_4bit = False
@@ -30,6 +176,7 @@ class HFModel:
             quant_config = BitsAndBytesConfig(load_in_4bit=True)
 
         dtype = torch.float16 if use_cuda else torch.float32
+        self.quantization = "4bit" if load_in_4bit else str(dtype).replace("torch.", "")
         device_map = "auto" if use_cuda else "cpu"
 
         if use_cuda:
@@ -43,29 +190,239 @@ class HFModel:
             dtype=dtype,
             quantization_config=quant_config,
         )
+        eos = self.model.generation_config.eos_token_id
+        if eos is None:
+            eos = self.tokenizer.eos_token_id
+        self.eos_token_ids = frozenset(eos if isinstance(eos, list) else [eos]) - {None}
+
+    def _generate_kwargs(self, config: GenerationConfig) -> dict:
+        return {
+            "max_new_tokens": config.max_new_tokens,
+            "temperature": config.temperature,
+            "top_p": config.top_p,
+            "do_sample": config.temperature > 0,
+            "pad_token_id": self.tokenizer.pad_token_id,
+        }
+
+    def _cache_key(self, prompt: str, config: GenerationConfig) -> Optional[str]:
+        if self.generation_cache is None or not is_cacheable(config):
+            return None
+        return GenerationCache.make_key(self.model_id, self.quantization, prompt, config)
+
+    def _timed_generate(self, inputs, kwargs: dict, spans: Spans, start_ns: int) -> tuple:
+        from transformers import LogitsProcessorList
+
+        sync = None
+        if self.model.device.type == "cuda":
+            import torch
+
+            sync = torch.cuda.synchronize
+        clock = _StepClock(sync)
+        output = self.model.generate(**inputs, **kwargs, logits_processor=LogitsProcessorList([clock]))
+        if sync is not None:
+            sync()
+        end_ns = time.perf_counter_ns()
+        prefill_end_ns = clock.steps[0] if clock.steps else end_ns
+        spans.add("prefill", prefill_end_ns - start_ns)
+        spans.add("decode", end_ns - prefill_end_ns)
+        return output, clock.steps
+
+    def _generated_ids(self, output: torch.Tensor, input_length: int) -> List[List[int]]:
+        # generate() echoes the (padded) prompt, and rows that finish early are
+        # filled with padding after their EOS, so keep each row up to its EOS.
+        rows = output[:, input_length:].tolist()
+        for row_index, row in enumerate(rows):
+            for n, token in enumerate(row):
+                if token in self.eos_token_ids:
+                    rows[row_index] = row[:n]
+                    break
+        return rows
 
-    def generate(self, prompt: str, config: Optional[GenerationConfig] = None) -> dict:
+    def _seed(self, config: GenerationConfig) -> None:
+        if config.seed is not None and config.temperature > 0:
+            import torch
+
+            torch.manual_seed(config.seed)
+
+    def generate(
+        self,
+        prompt: str,
+        config: Optional[GenerationConfig] = None,
+        stop: Optional[Callable[[str], bool]] = None,
+    ) -> dict:
+        """Generate a completion; with ``stop`` the call streams and can end early."""
         if config is None:
             config = GenerationConfig()
+        if stop is not None:
+            return self.generate_stream(prompt, config, stop).collect()
+        key = self._cache_key(prompt, config)
+        if key is not None:
+            cached = self.generation_cache.get(key)
+            if cached is not None:
+                return {**cached, "cache_hit": True}
+        result = self._generate_one(prompt, config)
+        if key is not None:
+            self.generation_cache.put(key, result)
+            result["cache_hit"] = False
+        return result
+
+    def generate_stream(
+        self,
+        prompt: str,
+        config: Optional[GenerationConfig] = None,
+        stop: Optional[Callable[[str], bool]] = None,
+    ) -> GenerationStream:
+        """Stream the completion of ``prompt``; ``stop`` sees the text generated so far.
+
+        Streams always run the model, bypassing the generation cache, since
+        their point is the timing of a live call.
+        """
+        from transformers import TextIteratorStreamer
 
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+        if config is None:
+            config = GenerationConfig()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        return GenerationStream(
+            lambda event: self._generate_one(prompt, config, streamer=streamer, stop_event=event), streamer, stop
+        )
+
+    def _generate_one(
+        self,
+        prompt: str,
+        config: GenerationConfig,
+        streamer=None,
+        stop_event: Optional[threading.Event] = None,
+    ) -> dict:
+        call_start_ns = time.perf_counter_ns()
+        spans = Spans()
+        with spans.span("tokenize"):
+            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
         tokens_in = inputs.input_ids.shape[-1]
+        kwargs = self._generate_kwargs(config)
+        if streamer is not None:
+            from transformers import StoppingCriteriaList
+
+            kwargs["streamer"] = streamer
+            kwargs["stopping_criteria"] = StoppingCriteriaList([_EventStop(stop_event)])
 
         with Timer() as timer:
-            output = self.model.generate(
-                **inputs,
-                max_new_tokens=config.max_new_tokens,
-                temperature=config.temperature,
-                top_p=config.top_p,
-                do_sample=config.temperature > 0,
-            )
+            reused = 0
+            if self.prefix_cache is not None:
+                kwargs["past_key_values"], reused = self._cached_prefix(inputs.input_ids)
+            self._seed(config)
+            output, steps = self._timed_generate(inputs, kwargs, spans, timer.start_ns)
 
-        text = self.tokenizer.decode(output[0], skip_special_tokens=True)
-        tokens_out = count_tokens(self.tokenizer, text)
+        generated_ids = self._generated_ids(output, tokens_in)[0]
+        with spans.span("detokenize"):
+            text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
 
-        return {
+        result = {
             "text": text,
             "tokens_in": tokens_in,
-            "tokens_out": tokens_out,
+            "tokens_out": len(generated_ids),
+            "generated_ids": generated_ids,
             "latency_ms": timer.elapsed_ms,
+            "spans_ns": spans.ns,
+            "prefill_tokens": tokens_in - reused,
+            # The first new token comes out of the prefill pass.
+            "decode_tokens": max(0, output.shape[-1] - tokens_in - 1),
+            **latency_profile(call_start_ns, steps),
         }
+        if self.prefix_cache is not None:
+            result["prefix_tokens_reused"] = reused
+            result["prefix_cache_hit_rate"] = self.prefix_cache.hit_rate
+        return result
+
+    def _cached_prefix(self, input_ids: torch.Tensor) -> tuple:
+        import torch
+        from transformers import DynamicCache
+
+        # Reuse the longest cached block-aligned prefix, prefill up to the next
+        # block boundary on top of it and store that for later prompts.
+        token_ids = input_ids[0].tolist()
+        cache, reused = self.prefix_cache.lookup(token_ids)
+        target = self.prefix_cache.aligned_length(len(token_ids))
+        if target > reused:
+            if cache is None:
+                cache = DynamicCache()
+            with torch.no_grad():
+                # Only the KV cache is wanted; skip the LM head on all but one position.
+                self.model(
+                    input_ids=input_ids[:, reused:target],
+                    past_key_values=cache,
+                    use_cache=True,
+                    logits_to_keep=1,
+                )
+            if self.prefix_cache.store(token_ids[:target], cache):
+                # generate() extends the cache in place, so it gets a private copy.
+                cache = copy.deepcopy(cache)
+        return cache, reused
+
+    def generate_batch(
+        self, prompts: List[str], config: Optional[GenerationConfig] = None
+    ) -> List[dict]:
+        if config is None:
+            config = GenerationConfig()
+        keys = [self._cache_key(prompt, config) for prompt in prompts]
+        results: List[Optional[dict]] = [None] * len(prompts)
+        for i, key in enumerate(keys):
+            if key is not None:
+                cached = self.generation_cache.get(key)
+                if cached is not None:
+                    results[i] = {**cached, "cache_hit": True}
+        misses = [i for i, result in enumerate(results) if result is None]
+        fresh = self._generate_many([prompts[i] for i in misses], config)
+        for i, result in zip(misses, fresh):
+            if keys[i] is not None:
+                self.generation_cache.put(keys[i], result)
+                result["cache_hit"] = False
+            results[i] = result
+        return results
+
+    def _generate_many(self, prompts: List[str], config: GenerationConfig) -> List[dict]:
+        if not prompts:
+            return []
+        # Left padding shifts every prompt by a different offset, so the prefix
+        # cache only applies to single-prompt calls.
+        if len(prompts) == 1 or (config.seed is not None and config.temperature > 0):
+            # A seeded sample is only reproducible when drawn on its own.
+            return [self._generate_one(prompt, config) for prompt in prompts]
+
+        call_start_ns = time.perf_counter_ns()
+        spans = Spans()
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            with spans.span("tokenize"):
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        finally:
+            self.tokenizer.padding_side = padding_side
+        tokens_in = inputs.attention_mask.sum(dim=-1).tolist()
+
+        # Left padding keeps every prompt flush against its first generated token.
+        # latency_ms, the spans and the token counts describe the whole shared
+        # call and are reported for each prompt.
+        with Timer() as timer:
+            kwargs = self._generate_kwargs(config)
+            output, steps = self._timed_generate(inputs, kwargs, spans, timer.start_ns)
+        profile = latency_profile(call_start_ns, steps)
+
+        generated = self._generated_ids(output, inputs.input_ids.shape[-1])
+        with spans.span("detokenize"):
+            texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        decode_tokens = max(0, output.shape[-1] - inputs.input_ids.shape[-1] - 1) * len(prompts)
+        return [
+            {
+                "text": text,
+                "tokens_in": int(n_in),
+                "tokens_out": len(generated_ids),
+                "generated_ids": generated_ids,
+                "latency_ms": timer.elapsed_ms,
+                "batch_size": len(prompts),
+                "spans_ns": spans.ns,
+                "prefill_tokens": int(sum(tokens_in)),
+                "decode_tokens": decode_tokens,
+                **profile,
+            }
+            for text, n_in, generated_ids in zip(texts, tokens_in, generated)
+        ]
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, Iterator, Sequence, Set
+
+import numpy as np
+
+from .utils import atomic_write_path
+
+
+class PassageStore:
+    """Read-only passage texts backed by a memory-mapped UTF-8 blob.
+
+    ``<prefix>.passages.bin`` holds the concatenated passages and
+    ``<prefix>.offsets.npy`` their byte offsets; passages are decoded lazily on
+    access, so the corpus does not have to be held in memory as Python strings.
+    """
+
+    def __init__(self, prefix: Path):
+        self.prefix = prefix
+        self.offsets = np.load(self.offsets_path(prefix), mmap_mode="r")
+        self._file = self.blob_path(prefix).open("rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @staticmethod
+    def blob_path(prefix: Path) -> Path:
+        return prefix.with_name(prefix.name + ".passages.bin")
+
+    @staticmethod
+    def offsets_path(prefix: Path) -> Path:
+        return prefix.with_name(prefix.name + ".offsets.npy")
+
+    @classmethod
+    def exists(cls, prefix: Path) -> bool:
+        return cls.blob_path(prefix).exists() and cls.offsets_path(prefix).exists()
+
+    @classmethod
+    def write(cls, passages: Sequence[str], prefix: Path) -> "PassageStore":
+        offsets = np.zeros(len(passages) + 1, dtype=np.int64)
+        blob_path = cls.blob_path(prefix)
+        with atomic_write_path(blob_path) as tmp_blob:
+            with tmp_blob.open("wb") as f:
+                for idx, passage in enumerate(passages):
+                    encoded = passage.encode("utf-8")
+                    f.write(encoded)
+                    offsets[idx + 1] = offsets[idx] + len(encoded)
+            # The blob is only moved into place once its offsets are.
+            with atomic_write_path(cls.offsets_path(prefix), suffix=".tmp.npy") as tmp_offsets:
+                np.save(tmp_offsets, offsets)
+        return cls(prefix)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return self._blob[start:end].decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def nbytes(self) -> int:
+        return int(self.offsets[-1]) + self.offsets.nbytes
+
+    def close(self) -> None:
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
+
+
+class PassageOverlay:
+    """Id-addressed passages: a base sequence plus in-memory additions and edits."""
+
+    def __init__(self, base: Sequence[str]):
+        self.base = base
+        self.updates: Dict[int, str] = {}
+        self.removed: Set[int] = set()
+
+    def __contains__(self, passage_id: int) -> bool:
+        if passage_id in self.updates:
+            return True
+        return 0 <= passage_id < len(self.base) and passage_id not in self.removed
+
+    def __getitem__(self, passage_id: int) -> str:
+        passage_id = int(passage_id)
+        text = self.updates.get(passage_id)
+        if text is not None:
+            return text
+        if passage_id not in self:
+            raise KeyError(passage_id)
+        return self.base[passage_id]
+
+    def __len__(self) -> int:
+        base_live = len(self.base) - len(self.removed)
+        return base_live + sum(1 for passage_id in self.updates if passage_id >= len(self.base))
+
+    def set(self, passage_id: int, text: str) -> None:
+        self.updates[passage_id] = text
+        self.removed.discard(passage_id)
+
+    def remove(self, passage_id: int) -> None:
+        self.updates.pop(passage_id, None)
+        if passage_id < len(self.base):
+            self.removed.add(passage_id)
+
+    def close(self) -> None:
+        if isinstance(self.base, PassageStore):
+            self.base.close()
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import copy
+import hashlib
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+def _cache_nbytes(cache: Any) -> int:
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        tensors = [
+            tensor
+            for layer in layers
+            for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None))
+            if tensor is not None
+        ]
+    else:
+        tensors = list(getattr(cache, "key_cache", [])) + list(getattr(cache, "value_cache", []))
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+@dataclass
+class _Entry:
+    cache: Any
+    num_tokens: int
+    nbytes: int
+    block_hashes: List[str] = field(default_factory=list)
+
+
+class PrefixCache:
+    """LRU store of ``past_key_values`` for block-aligned prompt prefixes.
+
+    Each stored entry is addressable by every block-aligned prefix it covers, so a
+    prompt sharing only the first few blocks with a cached one still reuses them.
+    """
+
+    def __init__(self, max_entries: int = 8, max_bytes: int = 1 << 30, block_size: int = 16):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._blocks: Dict[str, Tuple[str, int]] = {}
+        self._nbytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_saved = 0
+
+    def aligned_length(self, num_tokens: int) -> int:
+        # Always leave at least one token for generate() to prefill itself.
+        return ((num_tokens - 1) // self.block_size) * self.block_size
+
+    def _block_hashes(self, token_ids: Sequence[int]) -> List[str]:
+        hashes = []
+        digest = hashlib.blake2b(digest_size=16)
+        for start in range(0, self.aligned_length(len(token_ids) + 1), self.block_size):
+            digest.update(array("q", token_ids[start : start + self.block_size]).tobytes())
+            hashes.append(digest.copy().hexdigest())
+        return hashes
+
+    def lookup(self, token_ids: Sequence[int]) -> Tuple[Optional[Any], int]:
+        self.lookups += 1
+        hashes = self._block_hashes(token_ids[: self.aligned_length(len(token_ids))])
+        for block_hash in reversed(hashes):
+            match = self._blocks.get(block_hash)
+            if match is None:
+                continue
+            key, num_tokens = match
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            cache = copy.deepcopy(entry.cache)
+            if num_tokens < entry.num_tokens:
+                cache.crop(num_tokens)
+            self.hits += 1
+            self.tokens_saved += num_tokens
+            return cache, num_tokens
+        return None, 0
+
+    def store(self, token_ids: Sequence[int], cache: Any) -> bool:
+        """Keep ``cache`` for ``token_ids``; returns False when it was not stored."""
+        hashes = self._block_hashes(token_ids)
+        if not hashes or hashes[-1] in self._entries:
+            return False
+        nbytes = _cache_nbytes(cache)
+        if nbytes > self.max_bytes:
+            return False
+        key = hashes[-1]
+        self._entries[key] = _Entry(cache=cache, num_tokens=len(token_ids), nbytes=nbytes, block_hashes=hashes)
+        self._nbytes += nbytes
+        for idx, block_hash in enumerate(hashes, start=1):
+            self._blocks[block_hash] = (key, idx * self.block_size)
+        while len(self._entries) > self.max_entries or self._nbytes > self.max_bytes:
+            self._evict()
+        return True
+
+    def _evict(self) -> None:
+        key, entry = self._entries.popitem(last=False)
+        self._nbytes -= entry.nbytes
+        for block_hash in entry.block_hashes:
+            if self._blocks.get(block_hash, (None, 0))[0] == key:
+                del self._blocks[block_hash]
+        # Re-point shared blocks at a surviving entry that still covers them.
+        for other_key, other in self._entries.items():
+            for idx, block_hash in enumerate(other.block_hashes, start=1):
+                self._blocks.setdefault(block_hash, (other_key, idx * self.block_size))
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hit_rate,
+            "tokens_saved": self.tokens_saved,
+        }
@@ -1,15 +1,35 @@
 from __future__ import annotations
 
+import hashlib
+from collections import Counter
 from dataclasses import dataclass
-from typing import List, Optional
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
-import faiss
-from sentence_transformers import SentenceTransformer
-import torch
+import numpy as np
 
 from .base import Agent
-from .model import HFModel, GenerationConfig
+from .bm25 import BM25Index
+from .embedders import acquire_embedder, release_embedder, resolve_device
+from .model import HFModel, GenerationConfig, generation_metadata
 from .types import AgentResult, TaskInstance
+from .passage_store import PassageOverlay, PassageStore
+from .utils import Spans, atomic_write_path
+from .vector_index import (
+    AnyIndex,
+    BinaryRerankIndex,
+    EmbeddingTable,
+    build_index,
+    compare_with_flat,
+    index_signature,
+    read_index,
+    supports_gpu,
+    supports_removal,
+    write_index,
+)
+
+
+RETRIEVAL_MODES = ("dense", "sparse", "hybrid")
 
 
 @dataclass
@@ -18,6 +38,61 @@ class RAGConfig:
     embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
     use_gpu: bool = True
     cache_dir: Optional[str] = None
+    index_type: str = "flat"
+    nlist: Optional[int] = None
+    nprobe: int = 16
+    hnsw_m: int = 32
+    ef_construction: int = 80
+    ef_search: int = 64
+    train_sample_size: int = 50_000
+    pq_m: int = 16
+    pq_nbits: int = 8
+    binary_rerank_factor: int = 4
+    mmap_passages: bool = True
+    retrieval_mode: str = "dense"
+    bm25_k1: float = 1.5
+    bm25_b: float = 0.75
+    hybrid_candidates: int = 100
+    sparse_weight: float = 0.3
+    dense_weight: float = 0.7
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def corpus_cache_key(corpus: Sequence[str], embedding_model: str) -> str:
+    digest = hashlib.sha256(embedding_model.encode("utf-8"))
+    for passage in corpus:
+        encoded = passage.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()[:32]
+
+
+def _atomic_save_npy(array: np.ndarray, path: Path) -> None:
+    # np.save appends ".npy" to names without it, so the temporary name keeps it.
+    with atomic_write_path(path, suffix=".tmp.npy") as tmp_path:
+        np.save(tmp_path, array)
+
+
+def _vectors_path(prefix: Path) -> Path:
+    return prefix.with_name(f"{prefix.name}.npy")
+
+
+def _hashes_path(prefix: Path) -> Path:
+    return prefix.with_name(f"{prefix.name}.hashes.npy")
+
+
+def save_vectors(prefix: Path, hashes: Sequence[str], vectors: np.ndarray) -> None:
+    """Write ``<prefix>.npy`` with a row-aligned sidecar of passage content hashes."""
+    # The sidecar goes first, so an existing .npy always has its hashes.
+    _atomic_save_npy(np.asarray(hashes, dtype="S40"), _hashes_path(prefix))
+    _atomic_save_npy(np.ascontiguousarray(vectors, dtype=np.float32), _vectors_path(prefix))
+
+
+def load_hashes(prefix: Path) -> List[str]:
+    return [h.decode("ascii") for h in np.load(_hashes_path(prefix)).tolist()]
 
 
 class RAGAgent(Agent):
@@ -27,50 +102,435 @@ class RAGAgent(Agent):
         corpus: List[str],
         rag_config: Optional[RAGConfig] = None,
         gen_config: Optional[GenerationConfig] = None,
+        stop: Optional[Callable[[str], bool]] = None,
     ):
         super().__init__(name="rag")
         self.model = model
-        self.corpus = corpus
+        self.corpus: Sequence[str] = corpus
         self.rag_config = rag_config or RAGConfig()
         self.gen_config = gen_config
-        device = "cuda" if torch.cuda.is_available() and self.rag_config.use_gpu else "cpu"
-        print(f"Loading embedder: {self.rag_config.embedding_model} (device={device})")
-        self.embedder = SentenceTransformer(
+        self.stop = stop
+        self.device = resolve_device(self.rag_config.use_gpu)
+        self.embedder = acquire_embedder(
             self.rag_config.embedding_model,
-            device=device,
+            device=self.device,
             cache_folder=self.rag_config.cache_dir,
         )
+        self._index_path: Optional[Path] = None
+        self._next_id = len(corpus)
+        self._mutable = False
+        self._vector_cache: Dict[str, np.ndarray] = {}
+        # Vectors encoded after the cached matrix was written, persisted by content hash.
+        self._delta_prefix: Optional[Path] = None
+        self._delta_hashes: List[str] = []
+        self._cache_root = self._cache_prefix(corpus)
+        self._bm25: Optional[BM25Index] = None
+        if self.rag_config.retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(
+                f"Unknown retrieval mode: {self.rag_config.retrieval_mode} (expected one of {RETRIEVAL_MODES})"
+            )
         self.index = self._build_index(corpus)
 
-    def _build_index(self, corpus: List[str]) -> faiss.IndexFlatIP:
-        print(f"Building RAG index for {len(corpus)} passages")
-        embeddings = self.embedder.encode(
-            corpus,
-            normalize_embeddings=True,
-            show_progress_bar=True,
-        )
-        dim = embeddings.shape[1]
-        index = faiss.IndexFlatIP(dim)
-        index.add(embeddings)
-        if self.rag_config.use_gpu and faiss.get_num_gpus() > 0:
+    def close(self) -> None:
+        if self.embedder is not None:
+            release_embedder(self.rag_config.embedding_model, self.device)
+            self.embedder = None
+        if isinstance(self.corpus, (PassageStore, PassageOverlay)):
+            self.corpus.close()
+
+    def _cache_prefix(self, corpus: List[str]) -> Optional[Path]:
+        if not self.rag_config.cache_dir:
+            return None
+        model = self.rag_config.embedding_model
+        model_key = hashlib.sha256(model.encode("utf-8")).hexdigest()[:16]
+        return Path(self.rag_config.cache_dir) / "rag_index" / model_key / corpus_cache_key(corpus, model)
+
+    def _index_file(self, prefix: Path) -> Path:
+        # Embeddings and passages are shared by every index type built over the
+        # same corpus; only the index file is specific to the build parameters.
+        return prefix.with_name(f"{prefix.name}.{index_signature(self.rag_config)}.ids.faiss")
+
+    def _build_index(self, corpus: List[str]) -> AnyIndex:
+        prefix = self._cache_root
+        if prefix is None:
+            embeddings = self._encode_corpus(corpus)
+            print(f"Building {self.rag_config.index_type} RAG index for {len(corpus)} passages")
+            return self._use_index(embeddings, build_index(embeddings, self.rag_config))
+
+        if not _vectors_path(prefix).exists():
+            hashes = [content_hash(passage) for passage in corpus]
+            base = self._closest_cache(hashes)
+            if base is not None and self._patch_cached(*base, corpus, hashes):
+                return self.index
+            embeddings = self._encode_corpus(corpus, hashes, base)
+            save_vectors(prefix, hashes, embeddings)
+        # Passages are stored even when not memory-mapped so later corpora can patch this one.
+        if not PassageStore.exists(prefix):
+            PassageStore.write(corpus, prefix)
+        if self.rag_config.mmap_passages:
+            self.corpus = PassageStore(prefix)
+        self._load_delta(prefix)
+
+        embeddings = np.load(_vectors_path(prefix), mmap_mode="r")
+        index_path = self._index_file(prefix)
+        if index_path.exists():
+            print(f"Loading cached RAG index from {index_path}")
+            index = read_index(index_path, embeddings, self.rag_config)
+            self._index_path = index_path
+        else:
+            print(f"Building {self.rag_config.index_type} RAG index for {len(corpus)} passages")
+            index = build_index(embeddings, self.rag_config)
+            write_index(index, index_path)
+        return self._use_index(embeddings, index)
+
+    def _use_index(self, embeddings: np.ndarray, index: AnyIndex) -> AnyIndex:
+        self.embeddings = embeddings
+        self._cpu_index = index
+        return self._to_device(index)
+
+    def _encode_corpus(
+        self,
+        corpus: Sequence[str],
+        hashes: Sequence[str] = (),
+        base: Optional[Tuple[Path, List[str]]] = None,
+    ) -> np.ndarray:
+        """Embed ``corpus``, taking vectors of passages already cached under ``base``."""
+        if base is None:
+            print(f"Embedding {len(corpus)} passages for RAG index")
+            embeddings = self.embedder.encode(list(corpus), normalize_embeddings=True, show_progress_bar=True)
+            return np.ascontiguousarray(embeddings, dtype=np.float32)
+        base_prefix, base_hashes = base
+        base_vectors = np.load(_vectors_path(base_prefix), mmap_mode="r")
+        known = self._read_delta(base_prefix)[0]
+        rows = {h: row for row, h in enumerate(base_hashes)}
+        embeddings = np.empty((len(corpus), base_vectors.shape[1]), dtype=np.float32)
+        missing = []
+        for i, h in enumerate(hashes):
+            if h in rows:
+                embeddings[i] = base_vectors[rows[h]]
+            elif h in known:
+                embeddings[i] = known[h]
+            else:
+                missing.append(i)
+        print(f"Embedding {len(missing)} of {len(corpus)} passages for RAG index")
+        if missing:
+            vectors = self.embedder.encode(
+                [corpus[i] for i in missing], normalize_embeddings=True, show_progress_bar=True
+            )
+            embeddings[missing] = np.asarray(vectors, dtype=np.float32)
+        return embeddings
+
+    def _closest_cache(self, hashes: Sequence[str]) -> Optional[Tuple[Path, List[str]]]:
+        """The cached corpus for this embedding model sharing the most passages with ``hashes``."""
+        wanted = set(hashes)
+        best, best_shared = None, 0
+        for path in self._cache_root.parent.glob("*.hashes.npy"):
+            prefix = path.with_name(path.name[: -len(".hashes.npy")])
+            # Delta files (<key>.added) are not corpora of their own.
+            if "." in prefix.name or not _vectors_path(prefix).exists():
+                continue
+            cached = load_hashes(prefix)
+            shared = len(wanted.intersection(cached))
+            if shared > best_shared:
+                best, best_shared = (prefix, cached), shared
+        return best
+
+    def _patch_cached(
+        self, base_prefix: Path, base_hashes: List[str], corpus: Sequence[str], hashes: Sequence[str]
+    ) -> bool:
+        """Load the cached index of a similar corpus and apply the difference in place.
+
+        Returns False when the cached index cannot take the edits or more than half
+        of ``corpus`` would change, in which case a fresh index is cheaper.
+        """
+        index_path = self._index_file(base_prefix)
+        if not (index_path.exists() and PassageStore.exists(base_prefix)):
+            return False
+        pending = Counter(hashes)
+        removed = []
+        for passage_id, h in enumerate(base_hashes):
+            if pending[h] > 0:
+                pending[h] -= 1
+            else:
+                removed.append(passage_id)
+        added = []
+        for passage, h in zip(corpus, hashes):
+            if pending[h] > 0:
+                pending[h] -= 1
+                added.append(passage)
+        if len(removed) + len(added) > len(corpus) // 2:
+            return False
+        embeddings = np.load(_vectors_path(base_prefix), mmap_mode="r")
+        # Read privately rather than memory-mapped, since the index is edited right away.
+        index = read_index(index_path, embeddings, self.rag_config, mmap=False)
+        if removed and not supports_removal(index):
+            return False
+
+        print(f"Patching cached RAG index {index_path}: {len(added)} added, {len(removed)} removed")
+        store = PassageStore(base_prefix)
+        if self.rag_config.mmap_passages:
+            self.corpus = store
+        else:
+            self.corpus = list(store)
+            store.close()
+        self._load_delta(base_prefix)
+        self._next_id = len(base_hashes)
+        self.index = self._use_index(embeddings, index)
+        self.remove_passages(removed)
+        self.add_passages(added)
+        return True
+
+    def _read_delta(self, prefix: Path) -> Tuple[Dict[str, np.ndarray], List[str]]:
+        delta = prefix.with_name(f"{prefix.name}.added")
+        if not _vectors_path(delta).exists():
+            return {}, []
+        hashes = load_hashes(delta)
+        return dict(zip(hashes, np.load(_vectors_path(delta)))), hashes
+
+    def _load_delta(self, prefix: Path) -> None:
+        vectors, self._delta_hashes = self._read_delta(prefix)
+        self._vector_cache.update(vectors)
+        self._delta_prefix = prefix.with_name(f"{prefix.name}.added")
+
+    def _to_device(self, index: AnyIndex) -> AnyIndex:
+        import faiss
+
+        if self.rag_config.use_gpu and faiss.get_num_gpus() > 0 and supports_gpu(index):
             res = faiss.StandardGpuResources()
-            index = faiss.index_cpu_to_gpu(res, 0, index)
+            return faiss.index_cpu_to_gpu(res, 0, index)
         return index
 
-    def _retrieve(self, query: str) -> List[str]:
-        query_vec = self.embedder.encode([query], normalize_embeddings=True)
-        scores, indices = self.index.search(query_vec, self.rag_config.top_k)
-        return [self.corpus[i] for i in indices[0] if i >= 0]
+    def _ensure_mutable(self) -> None:
+        if self._mutable:
+            return
+        if self._index_path is not None:
+            # Cached indexes may be memory-mapped read-only; edits need a private copy.
+            self._cpu_index = read_index(self._index_path, self.embeddings, self.rag_config, mmap=False)
+            self.index = self._to_device(self._cpu_index)
+        self.embeddings = EmbeddingTable(self.embeddings)
+        if isinstance(self._cpu_index, BinaryRerankIndex):
+            self._cpu_index.embeddings = self.embeddings
+        self.corpus = PassageOverlay(self.corpus)
+        self._mutable = True
 
-    def run(self, instance: TaskInstance) -> AgentResult:
-        passages = self._retrieve(instance.input)
+    def _sparse_index(self) -> BM25Index:
+        if self._bm25 is not None:
+            return self._bm25
+        config = self.rag_config
+        prefix = None
+        if self._cache_root is not None and not self._mutable:
+            prefix = self._cache_root.with_name(f"{self._cache_root.name}.bm25-k{config.bm25_k1}-b{config.bm25_b}")
+            self._bm25 = BM25Index.load(prefix)
+        if self._bm25 is None:
+            if self._mutable:
+                passage_ids = self.embeddings.live_ids()
+            else:
+                passage_ids = np.arange(len(self.corpus), dtype=np.int64)
+            print(f"Building BM25 index for {len(passage_ids)} passages")
+            self._bm25 = BM25Index.build(
+                (self.corpus[i] for i in passage_ids),
+                passage_ids=passage_ids,
+                k1=config.bm25_k1,
+                b=config.bm25_b,
+            )
+            if prefix is not None:
+                self._bm25.save(prefix)
+        return self._bm25
+
+    def _embed(self, passages: Sequence[str]) -> np.ndarray:
+        # Only passages whose content hash has not been embedded before hit the encoder.
+        hashes = [content_hash(passage) for passage in passages]
+        missing = {h: passage for h, passage in zip(hashes, passages) if h not in self._vector_cache}
+        if missing:
+            vectors = self.embedder.encode(list(missing.values()), normalize_embeddings=True)
+            for h, vector in zip(missing, vectors):
+                self._vector_cache[h] = np.asarray(vector, dtype=np.float32)
+            if self._delta_prefix is not None:
+                self._delta_hashes.extend(missing)
+                save_vectors(
+                    self._delta_prefix,
+                    self._delta_hashes,
+                    np.stack([self._vector_cache[h] for h in self._delta_hashes]),
+                )
+        return np.stack([self._vector_cache[h] for h in hashes])
+
+    def _remember(self, passage_ids: Sequence[int]) -> None:
+        # Keep vectors of replaced or removed passages so restoring them is free.
+        vectors = self.embeddings[np.asarray(passage_ids, dtype=np.int64)]
+        for passage_id, vector in zip(passage_ids, vectors):
+            self._vector_cache[content_hash(self.corpus[passage_id])] = vector
+
+    def _index_add(self, vectors: np.ndarray, passage_ids: Sequence[int]) -> None:
+        ids = np.asarray(passage_ids, dtype=np.int64)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._cpu_index.add_with_ids(vectors, ids)
+        if self.index is not self._cpu_index:
+            self.index.add_with_ids(vectors, ids)
+
+    def _index_remove(self, passage_ids: Sequence[int]) -> None:
+        if not supports_removal(self._cpu_index):
+            raise ValueError(
+                f"RAG index type '{self.rag_config.index_type}' does not support removing passages"
+            )
+        self._cpu_index.remove_ids(np.asarray(passage_ids, dtype=np.int64))
+        if self.index is not self._cpu_index:
+            # GPU indexes cannot remove in place; re-upload the edited CPU index.
+            self.index = self._to_device(self._cpu_index)
+
+    def _check_ids(self, passage_ids: Sequence[int]) -> None:
+        unknown = [passage_id for passage_id in passage_ids if passage_id not in self.corpus]
+        if unknown:
+            raise KeyError(f"Unknown passage ids: {unknown}")
+
+    def add_passages(self, passages: Sequence[str]) -> List[int]:
+        self._ensure_mutable()
+        passage_ids = list(range(self._next_id, self._next_id + len(passages)))
+        if not passage_ids:
+            return []
+        vectors = self._embed(passages)
+        self._index_add(vectors, passage_ids)
+        self._next_id += len(passage_ids)
+        for passage_id, passage, vector in zip(passage_ids, passages, vectors):
+            self.corpus.set(passage_id, passage)
+            self.embeddings.set(passage_id, vector)
+        self._bm25 = None
+        return passage_ids
+
+    def update_passage(self, passage_id: int, passage: str) -> None:
+        self._ensure_mutable()
+        self._check_ids([passage_id])
+        if self.corpus[passage_id] == passage:
+            return
+        vectors = self._embed([passage])
+        self._remember([passage_id])
+        self._index_remove([passage_id])
+        self._index_add(vectors, [passage_id])
+        self.corpus.set(passage_id, passage)
+        self.embeddings.set(passage_id, vectors[0])
+        self._bm25 = None
+
+    def remove_passages(self, passage_ids: Sequence[int]) -> None:
+        self._ensure_mutable()
+        passage_ids = list(dict.fromkeys(passage_ids))
+        self._check_ids(passage_ids)
+        if not passage_ids:
+            return
+        self._remember(passage_ids)
+        self._index_remove(passage_ids)
+        for passage_id in passage_ids:
+            self.corpus.remove(passage_id)
+            self.embeddings.discard(passage_id)
+        # The CSR postings are immutable; BM25 is rebuilt lazily on the next sparse query.
+        self._bm25 = None
+
+    def compare_with_flat(self, queries: Sequence[str], k: Optional[int] = None) -> Dict[str, float]:
+        query_vecs = self.embedder.encode(list(queries), normalize_embeddings=True)
+        ids = self.embeddings.live_ids() if isinstance(self.embeddings, EmbeddingTable) else None
+        return compare_with_flat(self.index, self.embeddings, query_vecs, k or self.rag_config.top_k, ids=ids)
+
+    def _dense_search(self, query_vecs: np.ndarray) -> List[List[int]]:
+        scores, indices = self.index.search(
+            np.ascontiguousarray(query_vecs, dtype=np.float32), self.rag_config.top_k
+        )
+        return [[int(i) for i in row if i >= 0] for row in indices]
+
+    def _hybrid_search(self, queries: Sequence[str], query_vecs: np.ndarray) -> List[List[int]]:
+        # Score BM25 candidates first and dense-rerank only that shortlist; queries
+        # without any lexical match fall back to the dense index.
+        config = self.rag_config
+        results: List[List[int]] = []
+        fallback = []
+        for row, (query, query_vec) in enumerate(zip(queries, query_vecs)):
+            sparse_scores, candidates = self._sparse_index().search(query, config.hybrid_candidates)
+            if not len(candidates):
+                fallback.append(row)
+                results.append([])
+                continue
+            dense_scores = self.embeddings[candidates] @ np.asarray(query_vec, dtype=np.float32)
+            fused = config.sparse_weight * sparse_scores / sparse_scores.max() + config.dense_weight * dense_scores
+            top = np.argsort(-fused, kind="stable")[: config.top_k]
+            results.append([int(candidates[i]) for i in top])
+        if fallback:
+            for row, passage_ids in zip(fallback, self._dense_search(query_vecs[fallback])):
+                results[row] = passage_ids
+        return results
+
+    def retrieve_batch(self, queries: Sequence[str], spans: Optional[Spans] = None) -> List[List[str]]:
+        if not queries:
+            return []
+        if spans is None:
+            spans = Spans()
+        mode = self.rag_config.retrieval_mode
+        if mode == "sparse":
+            with spans.span("retrieve.search"):
+                hits = [ids.tolist() for _, ids in self._sparse_index().search_batch(queries, self.rag_config.top_k)]
+        else:
+            with spans.span("retrieve.encode"):
+                query_vecs = np.asarray(
+                    self.embedder.encode(list(queries), normalize_embeddings=True), dtype=np.float32
+                )
+            with spans.span("retrieve.search"):
+                if mode == "hybrid":
+                    hits = self._hybrid_search(queries, query_vecs)
+                else:
+                    hits = self._dense_search(query_vecs)
+        return [[self.corpus[i] for i in passage_ids] for passage_ids in hits]
+
+    def _retrieve(self, query: str, spans: Optional[Spans] = None) -> List[str]:
+        return self.retrieve_batch([query], spans)[0]
+
+    def _build_prompt(self, query: str, passages: List[str]) -> str:
         context = "\n\n".join(passages)
-        prompt = f"Context:\n{context}\n\nQuestion:\n{instance.input}\n\nAnswer:"
-        result = self.model.generate(prompt, self.gen_config)
+        return f"Context:\n{context}\n\nQuestion:\n{query}\n\nAnswer:"
+
+    def _to_result(self, result: dict, spans: Spans) -> AgentResult:
         return AgentResult(
             text=result["text"],
             tokens_in=result["tokens_in"],
             tokens_out=result["tokens_out"],
             latency_ms=result["latency_ms"],
-            metadata={"agent": self.name, "top_k": self.rag_config.top_k},
+            metadata={
+                "agent": self.name,
+                "top_k": self.rag_config.top_k,
+                "retrieval_mode": self.rag_config.retrieval_mode,
+                **generation_metadata(result),
+                **spans.metadata(),
+            },
         )
+
+    def run(self, instance: TaskInstance) -> AgentResult:
+        spans = Spans()
+        with spans.span("total"):
+            passages = self._retrieve(instance.input, spans)
+            prompt = self._build_prompt(instance.input, passages)
+            result = self.model.generate(prompt, self.gen_config, stop=self.stop)
+        return self._to_result(result, spans.add_calls([result]))
+
+    def prepare(self, instances: Sequence[TaskInstance]) -> List[Tuple[str, Spans]]:
+        # Every prompt carries the batch's retrieval spans on to run_prepared.
+        spans = Spans()
+        with spans.span("total"):
+            queries = [inst.input for inst in instances]
+            prompts = [
+                self._build_prompt(query, passages)
+                for query, passages in zip(queries, self.retrieve_batch(queries, spans))
+            ]
+        return [(prompt, spans) for prompt in prompts]
+
+    def run_prepared(self, prepared: List[Tuple[str, Spans]]) -> List[AgentResult]:
+        if not prepared:
+            return []
+        # Time spent queued between prepare() and here is not part of "total".
+        spans = Spans().update(prepared[0][1])
+        with spans.span("total"):
+            prompts = [prompt for prompt, _ in prepared]
+            if self.stop is not None:
+                # Streams with a stop condition decode one prompt at a time.
+                results = [self.model.generate(prompt, self.gen_config, stop=self.stop) for prompt in prompts]
+            else:
+                results = self.model.generate_batch(prompts, self.gen_config)
+        spans.add_calls(results)
+        return [self._to_result(result, spans) for result in results]
+
+    def run_batch(self, instances: Sequence[TaskInstance]) -> List[AgentResult]:
+        return self.run_prepared(self.prepare(instances))
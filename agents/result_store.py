@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import List, Set, Tuple
+
+RunKey = Tuple[str, str, str]
+
+
+def record_key(record: dict) -> RunKey:
+    return (record.get("benchmark"), record.get("agent"), record.get("instance_id"))
+
+
+def index_path(path: Path) -> Path:
+    return path.with_name(path.name + ".idx")
+
+
+class ResultStore:
+    """Append-only JSONL output with a sidecar index of completed keys.
+
+    Each index line is ``[end_offset, benchmark, agent, instance_id]`` and is only
+    written after the record it points at has been fsynced, so the index never
+    runs ahead of the data. Resuming loads the index, then parses just the records
+    appended after its last entry and truncates a torn final line.
+    """
+
+    def __init__(self, path: str | Path, resume: bool = False, fsync_every: int = 64, fsync_interval: float = 5.0):
+        self.path = Path(path)
+        self.idx_path = index_path(self.path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.seen: Set[RunKey] = set()
+        self._pending: List[str] = []
+        self._last_sync = time.monotonic()
+        if resume and self.path.exists():
+            end = self._recover()
+            self._data = self.path.open("r+b")
+            self._data.seek(end)
+            self._data.truncate()
+            self._index = self.idx_path.open("ab")
+        else:
+            self._data = self.path.open("wb")
+            self._index = self.idx_path.open("wb")
+        self._offset = self._data.tell()
+
+    def _load_index(self, data_size: int) -> Tuple[int, List[bytes]]:
+        end = 0
+        lines: List[bytes] = []
+        if not self.idx_path.exists():
+            return end, lines
+        with self.idx_path.open("rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    offset, benchmark, agent, instance_id = json.loads(line)
+                except ValueError:
+                    break
+                if offset > data_size:
+                    break
+                self.seen.add((benchmark, agent, instance_id))
+                end = offset
+                lines.append(line)
+        return end, lines
+
+    def _recover(self) -> int:
+        data_size = self.path.stat().st_size
+        end, lines = self._load_index(data_size)
+        recovered = 0
+        with self.path.open("rb") as f:
+            f.seek(end)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                end += len(line)
+                key = record_key(record)
+                self.seen.add(key)
+                lines.append(self._index_line(end, key).encode("utf-8"))
+                recovered += 1
+        if end < data_size:
+            print(f"Truncating {data_size - end} bytes of partial output at the end of {self.path}")
+        if recovered:
+            print(f"Indexed {recovered} records missing from {self.idx_path}")
+        # Rewrite the index so it matches the data exactly before appending to either.
+        tmp = self.idx_path.with_name(self.idx_path.name + ".tmp")
+        with tmp.open("wb") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.idx_path)
+        return end
+
+    @staticmethod
+    def _index_line(end: int, key: RunKey) -> str:
+        return json.dumps([end, *key]) + "\n"
+
+    def __contains__(self, key: RunKey) -> bool:
+        return key in self.seen
+
+    def __len__(self) -> int:
+        return len(self.seen)
+
+    def write(self, record: dict) -> None:
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        self._data.write(line)
+        self._offset += len(line)
+        key = record_key(record)
+        self.seen.add(key)
+        self._pending.append(self._index_line(self._offset, key))
+        if len(self._pending) >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        if self._pending:
+            self._index.write("".join(self._pending).encode("utf-8"))
+            self._pending.clear()
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._last_sync = time.monotonic()
+
+    def flush(self) -> None:
+        # Called by the runner whenever its write queue drains; keep fsyncs batched.
+        if len(self._pending) >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+        else:
+            self._data.flush()
+
+    def close(self) -> None:
+        if self._data.closed:
+            return
+        self.sync()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:  # pragma: no cover
+        raise ImportError(
+            "Parquet output needs pyarrow; install it with `pip install .[parquet]`"
+        ) from exc
+    return pa, pq
+
+
+DICTIONARY_COLUMNS = ("benchmark", "agent", "task_type")
+
+
+def record_schema():
+    pa, _ = _import_pyarrow()
+    label = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("benchmark", label),
+            ("agent", label),
+            ("instance_id", pa.string()),
+            ("task_type", label),
+            ("output", pa.string()),
+            ("reference", pa.string()),
+            ("evidence", pa.list_(pa.string())),
+            ("tokens_in", pa.int64()),
+            ("tokens_out", pa.int64()),
+            ("latency_ms", pa.int64()),
+            # Metadata keys differ per agent, so it is kept as a JSON string.
+            ("metadata", pa.string()),
+        ]
+    )
+
+
+class ParquetResultStore:
+    """Run records in a zstd-compressed Parquet file, one row group per batch.
+
+    Parquet files are only readable once their footer is written, so rows go to
+    ``<path>.tmp`` and replace ``path`` on close. Resuming reads just the key
+    columns of the existing file and copies its row groups into the new one, so
+    a crash never loses the last completed file.
+    """
+
+    def __init__(self, path: str | Path, resume: bool = False, row_group_size: int = 1024):
+        pa, pq = _import_pyarrow()
+        self._pa = pa
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.row_group_size = row_group_size
+        self.schema = record_schema()
+        self.seen: Set[RunKey] = set()
+        self._rows: List[dict] = []
+        self._writer = pq.ParquetWriter(
+            str(self.tmp_path),
+            self.schema,
+            compression="zstd",
+            use_dictionary=list(DICTIONARY_COLUMNS),
+        )
+        if resume and self.path.exists():
+            existing = pq.ParquetFile(str(self.path))
+            keys = existing.read(columns=["benchmark", "agent", "instance_id"])
+            self.seen.update(zip(*(keys.column(name).to_pylist() for name in keys.column_names)))
+            for i in range(existing.num_row_groups):
+                self._writer.write_table(existing.read_row_group(i).cast(self.schema))
+
+    def __contains__(self, key: RunKey) -> bool:
+        return key in self.seen
+
+    def __len__(self) -> int:
+        return len(self.seen)
+
+    def write(self, record: dict) -> None:
+        self.seen.add(record_key(record))
+        self._rows.append({**record, "metadata": json.dumps(record.get("metadata") or {})})
+        if len(self._rows) >= self.row_group_size:
+            self.sync()
+
+    def sync(self) -> None:
+        if self._rows:
+            columns = {name: [row.get(name) for row in self._rows] for name in self.schema.names}
+            self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self.schema))
+            self._rows.clear()
+
+    def flush(self) -> None:
+        if len(self._rows) >= self.row_group_size:
+            self.sync()
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self.sync()
+        self._writer.close()
+        self._writer = None
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self) -> "ParquetResultStore":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+def open_result_store(path: str | Path, resume: bool = False):
+    if Path(path).suffix == ".parquet":
+        return ParquetResultStore(path, resume=resume)
+    return ResultStore(path, resume=resume)
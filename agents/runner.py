@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List
+
+from .base import Agent
+from .types import AgentResult, TaskInstance
+
+
+@dataclass
+class WorkUnit:
+    benchmark: str
+    agent: Agent
+    instances: List[TaskInstance]
+
+
+@dataclass
+class StageStats:
+    busy_s: float = 0.0
+    blocked_s: float = 0.0
+    items: int = 0
+
+
+@dataclass
+class RunStats:
+    stages: Dict[str, StageStats] = field(
+        default_factory=lambda: {name: StageStats() for name in ("prepare", "generate", "write")}
+    )
+
+    def summary(self) -> str:
+        return " | ".join(
+            f"{name}: busy {stage.busy_s:.1f}s, blocked {stage.blocked_s:.1f}s, {stage.items} items"
+            for name, stage in self.stages.items()
+        )
+
+
+def build_record(benchmark: str, agent: Agent, instance: TaskInstance, result: AgentResult) -> dict:
+    return {
+        "benchmark": benchmark,
+        "agent": agent.name,
+        "instance_id": instance.id,
+        "task_type": instance.task_type,
+        "output": result.text,
+        "reference": instance.reference,
+        "evidence": instance.evidence,
+        "tokens_in": result.tokens_in,
+        "tokens_out": result.tokens_out,
+        "latency_ms": result.latency_ms,
+        "metadata": result.metadata,
+    }
+
+
+def _log_unit(unit: WorkUnit) -> None:
+    print(f"  Agent: {unit.agent.name} | Instances: {', '.join(inst.id for inst in unit.instances)}")
+
+
+def run_serial(units: Iterable[WorkUnit], writer: Any) -> RunStats:
+    stats = RunStats()
+    for unit in units:
+        _log_unit(unit)
+        start = time.perf_counter()
+        results = unit.agent.run_batch(unit.instances)
+        stats.stages["generate"].busy_s += time.perf_counter() - start
+        stats.stages["generate"].items += len(results)
+        start = time.perf_counter()
+        for instance, result in zip(unit.instances, results):
+            writer.write(build_record(unit.benchmark, unit.agent, instance, result))
+        # Per unit, like the pipelined writer, so lease completion keeps pace with the run.
+        writer.flush()
+        stats.stages["write"].busy_s += time.perf_counter() - start
+        stats.stages["write"].items += len(results)
+    return stats
+
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _timed_put(q: "queue.Queue", item: Any, stage: StageStats) -> None:
+    start = time.perf_counter()
+    q.put(item)
+    stage.blocked_s += time.perf_counter() - start
+
+
+def _timed_get(q: "queue.Queue", stage: StageStats) -> Any:
+    start = time.perf_counter()
+    item = q.get()
+    stage.blocked_s += time.perf_counter() - start
+    return item
+
+
+def run_pipelined(
+    units: Iterable[WorkUnit],
+    writer: Any,
+    prefetch_depth: int = 2,
+    write_queue_depth: int = 256,
+) -> RunStats:
+    """Overlap preparation, generation and writing across three threads.
+
+    A producer thread iterates ``units`` (building agents lazily if the iterable
+    does so) and runs ``Agent.prepare``; the calling thread runs generation; a
+    writer thread serializes records and flushes whenever its queue drains. The
+    bounded queues apply back-pressure, and the time each stage waits on them is
+    reported as ``blocked_s``.
+    """
+    stats = RunStats()
+    prepared_q: "queue.Queue" = queue.Queue(maxsize=max(1, prefetch_depth))
+    write_q: "queue.Queue" = queue.Queue(maxsize=max(1, write_queue_depth))
+    stop = threading.Event()
+
+    def produce() -> None:
+        stage = stats.stages["prepare"]
+        try:
+            for unit in units:
+                if stop.is_set():
+                    return
+                start = time.perf_counter()
+                prepared = unit.agent.prepare(unit.instances)
+                stage.busy_s += time.perf_counter() - start
+                stage.items += len(unit.instances)
+                _timed_put(prepared_q, (unit, prepared), stage)
+            _timed_put(prepared_q, _DONE, stage)
+        except BaseException as exc:  # noqa: BLE001
+            prepared_q.put(_Failure(exc))
+
+    write_error: List[BaseException] = []
+
+    def consume() -> None:
+        stage = stats.stages["write"]
+        while True:
+            item = _timed_get(write_q, stage)
+            if item is _DONE:
+                break
+            if write_error:
+                continue
+            start = time.perf_counter()
+            try:
+                writer.write(item)
+                if write_q.empty():
+                    writer.flush()
+            except BaseException as exc:  # noqa: BLE001
+                write_error.append(exc)
+                stop.set()
+            stage.busy_s += time.perf_counter() - start
+            stage.items += 1
+        writer.flush()
+
+    producer = threading.Thread(target=produce, name="runner-prepare", daemon=True)
+    consumer = threading.Thread(target=consume, name="runner-write", daemon=True)
+    producer.start()
+    consumer.start()
+
+    stage = stats.stages["generate"]
+    try:
+        while not stop.is_set():
+            item = _timed_get(prepared_q, stage)
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc
+            unit, prepared = item
+            _log_unit(unit)
+            start = time.perf_counter()
+            results = unit.agent.run_prepared(prepared)
+            stage.busy_s += time.perf_counter() - start
+            stage.items += len(results)
+            for instance, result in zip(unit.instances, results):
+                _timed_put(write_q, build_record(unit.benchmark, unit.agent, instance, result), stage)
+    finally:
+        stop.set()
+        # Unblock a producer waiting on a full queue before joining it.
+        while producer.is_alive():
+            try:
+                prepared_q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        write_q.put(_DONE)
+        consumer.join()
+    if write_error:
+        raise write_error[0]
+    return stats
+
+
+def run_units(
+    units: Iterable[WorkUnit],
+    writer: Any,
+    pipelined: bool = False,
+    prefetch_depth: int = 2,
+    write_queue_depth: int = 256,
+) -> RunStats:
+    if pipelined:
+        return run_pipelined(units, writer, prefetch_depth, write_queue_depth)
+    return run_serial(units, writer)
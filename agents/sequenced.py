@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
 
 from .base import Agent
-from .model import HFModel, GenerationConfig
+from .model import HFModel, GenerationConfig, generation_metadata
 from .types import AgentResult, TaskInstance
+from .utils import Spans, Timer, batched, chunk_by_tokens
 
 
 class SequencedMultiAgent(Agent):
@@ -14,38 +16,192 @@ class SequencedMultiAgent(Agent):
         worker_b: HFModel,
         coordinator: HFModel,
         config: Optional[GenerationConfig] = None,
+        parallel: bool = False,
+        chunk_tokens: Optional[int] = None,
+        fan_in: int = 2,
+        max_batch_size: Optional[int] = 8,
     ):
         super().__init__(name="sequenced")
         self.worker_a = worker_a
         self.worker_b = worker_b
         self.coordinator = coordinator
         self.config = config
+        self.parallel = parallel
+        # chunk_tokens switches from the two-way character split to map-reduce:
+        # token-budgeted chunks are analysed as one batch and merged in a tree of
+        # fan_in analyses per coordinator call.
+        self.chunk_tokens = chunk_tokens
+        self.fan_in = max(2, fan_in)
+        # Prompts per generate_batch call, so memory per call stays bounded;
+        # None sends each phase as a single batch.
+        self.max_batch_size = max_batch_size
 
-    def run(self, instance: TaskInstance) -> AgentResult:
-        text = instance.input
+    def _split(self, text: str) -> Tuple[str, str]:
         midpoint = max(1, len(text) // 2)
-        part_a = text[:midpoint]
-        part_b = text[midpoint:]
-
-        result_a = self.worker_a.generate(f"Process part A:\n{part_a}", self.config)
-        result_b = self.worker_b.generate(f"Process part B:\n{part_b}", self.config)
+        return f"Process part A:\n{text[:midpoint]}", f"Process part B:\n{text[midpoint:]}"
 
-        merge_prompt = (
+    def _merge_prompt(self, result_a: dict, result_b: dict) -> str:
+        return (
             "Combine the following two analyses into a single answer.\n\n"
             f"Analysis A:\n{result_a['text']}\n\n"
             f"Analysis B:\n{result_b['text']}\n\n"
             "Final answer:"
         )
-        result = self.coordinator.generate(merge_prompt, self.config)
 
+    def _reduce_prompt(self, texts: List[str], final: bool) -> str:
+        analyses = "\n\n".join(f"Analysis {idx}:\n{text}" for idx, text in enumerate(texts, start=1))
+        closing = "Final answer:" if final else "Combined analysis:"
+        return f"Combine the following {len(texts)} analyses into a single answer.\n\n{analyses}\n\n{closing}"
+
+    def _generate(self, model: HFModel, prompts: List[str]) -> List[dict]:
+        if self.max_batch_size is None:
+            return model.generate_batch(prompts, self.config)
+        results: List[dict] = []
+        for chunk in batched(prompts, self.max_batch_size):
+            results.extend(model.generate_batch(chunk, self.config))
+        return results
+
+    def _run_workers(self, prompts_a: List[str], prompts_b: List[str]) -> Tuple[List[dict], List[dict]]:
+        if not self.parallel:
+            return self._generate(self.worker_a, prompts_a), self._generate(self.worker_b, prompts_b)
+        if self.worker_a is self.worker_b:
+            # One model serves both halves: decode them together as a single batch.
+            results = self._generate(self.worker_a, prompts_a + prompts_b)
+            return results[: len(prompts_a)], results[len(prompts_a) :]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            future_a = pool.submit(self._generate, self.worker_a, prompts_a)
+            future_b = pool.submit(self._generate, self.worker_b, prompts_b)
+            return future_a.result(), future_b.result()
+
+    def _to_result(
+        self, result: dict, result_a: dict, result_b: dict, wall_ms: int, spans: Spans
+    ) -> AgentResult:
+        metadata = generation_metadata(result)
+        if "prefill_tokens_saved" in metadata:
+            metadata["prefill_tokens_saved"] += sum(
+                generation_metadata(worker).get("prefill_tokens_saved", 0)
+                for worker in (result_a, result_b)
+            )
         return AgentResult(
             text=result["text"],
             tokens_in=result["tokens_in"],
             tokens_out=result["tokens_out"],
-            latency_ms=result["latency_ms"],
+            latency_ms=wall_ms,
             metadata={
                 "agent": self.name,
+                "parallel": self.parallel,
                 "worker_a_tokens": result_a["tokens_in"],
                 "worker_b_tokens": result_b["tokens_in"],
+                "worker_a_latency_ms": result_a["latency_ms"],
+                "worker_b_latency_ms": result_b["latency_ms"],
+                "coordinator_latency_ms": result["latency_ms"],
+                **metadata,
+                **spans.metadata(),
             },
         )
+
+    def run(self, instance: TaskInstance) -> AgentResult:
+        return self.run_batch([instance])[0]
+
+    def _run_map_reduce(self, instances: Sequence[TaskInstance]) -> List[AgentResult]:
+        with Timer() as timer:
+            owners = []
+            prompts = []
+            for owner, inst in enumerate(instances):
+                chunks = chunk_by_tokens(self.worker_a.tokenizer, inst.input, self.chunk_tokens)
+                for idx, chunk in enumerate(chunks, start=1):
+                    owners.append(owner)
+                    prompts.append(f"Process part {idx} of {len(chunks)}:\n{chunk}")
+
+            # Map: all chunks of all instances in one pass, alternating between workers.
+            with Timer() as map_timer:
+                results_a, results_b = self._run_workers(prompts[0::2], prompts[1::2])
+            mapped = [None] * len(prompts)
+            mapped[0::2] = results_a
+            mapped[1::2] = results_b
+
+            partials: List[List[dict]] = [[] for _ in instances]
+            for owner, result in zip(owners, mapped):
+                partials[owner].append(result)
+            map_tokens_in = [sum(result["tokens_in"] for result in level) for level in partials]
+            num_chunks = [len(level) for level in partials]
+
+            # Reduce: every level of every instance's tree is one coordinator batch.
+            # A single-chunk instance needs no reduce call: its analysis is the answer.
+            final: List[Optional[dict]] = [level[0] if len(level) == 1 else None for level in partials]
+            reduce_levels = [0] * len(instances)
+            levels = 0
+            reduced: List[dict] = []
+            with Timer() as reduce_timer:
+                while any(result is None for result in final):
+                    jobs = []
+                    next_partials: List[List[Optional[dict]]] = [[] for _ in instances]
+                    for owner, level in enumerate(partials):
+                        if final[owner] is not None:
+                            continue
+                        groups = batched(level, self.fan_in)
+                        for group in groups:
+                            if len(group) == 1:
+                                # A trailing singleton has nothing to combine; it moves up as is.
+                                next_partials[owner].append(group[0])
+                                continue
+                            is_final = len(groups) == 1
+                            texts = [result["text"] for result in group]
+                            prompt = self._reduce_prompt(texts, is_final)
+                            jobs.append((owner, len(next_partials[owner]), is_final, prompt))
+                            next_partials[owner].append(None)
+                    outputs = self._generate(self.coordinator, [prompt for *_, prompt in jobs])
+                    reduced.extend(outputs)
+                    for (owner, slot, is_final, _), output in zip(jobs, outputs):
+                        if is_final:
+                            final[owner] = output
+                            reduce_levels[owner] = levels + 1
+                        else:
+                            next_partials[owner][slot] = output
+                    partials = next_partials
+                    levels += 1
+
+        # Spans cover every model call of the batch, like latency_ms.
+        spans = Spans().add_calls(mapped + reduced)
+        spans.add("total", timer.elapsed_ns)
+        return [
+            AgentResult(
+                text=result["text"],
+                tokens_in=result["tokens_in"],
+                tokens_out=result["tokens_out"],
+                latency_ms=timer.elapsed_ms,
+                metadata={
+                    "agent": self.name,
+                    "mode": "map_reduce",
+                    "parallel": self.parallel,
+                    "chunks": chunks,
+                    "chunk_tokens": self.chunk_tokens,
+                    "fan_in": self.fan_in,
+                    "reduce_levels": depth,
+                    "map_tokens_in": tokens_in,
+                    "map_latency_ms": map_timer.elapsed_ms,
+                    "reduce_latency_ms": reduce_timer.elapsed_ms,
+                    **generation_metadata(result),
+                    **spans.metadata(),
+                },
+            )
+            for result, chunks, depth, tokens_in in zip(final, num_chunks, reduce_levels, map_tokens_in)
+        ]
+
+    def run_batch(self, instances: Sequence[TaskInstance]) -> List[AgentResult]:
+        if self.chunk_tokens:
+            return self._run_map_reduce(instances)
+        # latency_ms is the wall time of the whole agent call (both workers plus the
+        # merge); per-role latencies are reported in metadata.
+        with Timer() as timer:
+            splits = [self._split(inst.input) for inst in instances]
+            results_a, results_b = self._run_workers([a for a, _ in splits], [b for _, b in splits])
+            merged = self._generate(
+                self.coordinator, [self._merge_prompt(a, b) for a, b in zip(results_a, results_b)]
+            )
+        spans = Spans().add_calls(results_a + results_b + merged)
+        spans.add("total", timer.elapsed_ns)
+        return [
+            self._to_result(result, result_a, result_b, timer.elapsed_ms, spans)
+            for result, result_a, result_b in zip(merged, results_a, results_b)
+        ]
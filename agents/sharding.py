@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import hashlib
+import glob
+import os
+import re
+import socket
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+RunKey = Tuple[str, str, str]
+
+
+def key_digest(key: RunKey) -> str:
+    return hashlib.blake2b("\x1f".join(key).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def shard_of(key: RunKey, num_shards: int) -> int:
+    # Stable across processes and hosts, unlike the salted builtin hash().
+    return int(key_digest(key), 16) % num_shards
+
+
+def shard_output_path(path: Path, shard_index: int, num_shards: int) -> Path:
+    return path.with_name(f"{path.stem}.shard-{shard_index:03d}-of-{num_shards:03d}{path.suffix}")
+
+
+def shard_output_paths(path: Path, num_shards: int) -> List[Path]:
+    return [shard_output_path(path, i, num_shards) for i in range(num_shards)]
+
+
+def lease_output_path(path: Path, owner: str) -> Path:
+    # Lease workers are not numbered, so each writes a file named after its owner.
+    safe_owner = re.sub(r"[^A-Za-z0-9_.-]", "_", owner)
+    return path.with_name(f"{path.stem}.lease-{safe_owner}{path.suffix}")
+
+
+def lease_output_paths(path: Path) -> List[Path]:
+    pattern = f"{glob.escape(path.stem)}.lease-*{glob.escape(path.suffix)}"
+    return sorted(path.parent.glob(pattern))
+
+
+def check_lease_output(path: Path) -> None:
+    # Parquet rows only become readable once the file is closed, so a lease
+    # completed after sync() could point at records a crash destroys.
+    if path.suffix == ".parquet":
+        raise ValueError(f"Lease mode needs JSONL output, got {path}; merge the shards into Parquet afterwards")
+
+
+class LeaseQueue:
+    """Work queue shared through a directory of lease and done marker files.
+
+    ``claim`` creates ``<digest>.lease`` with ``O_EXCL`` so exactly one worker wins
+    a key; a lease older than ``lease_seconds`` is considered abandoned and may be
+    taken over. ``complete`` drops a ``<digest>.done`` marker so no worker picks
+    the key up again.
+    """
+
+    def __init__(self, directory: Path, lease_seconds: float = 1800.0, owner: Optional[str] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+
+    def _path(self, key: RunKey, suffix: str) -> Path:
+        return self.directory / f"{key_digest(key)}.{suffix}"
+
+    def is_done(self, key: RunKey) -> bool:
+        return self._path(key, "done").exists()
+
+    def claim(self, key: RunKey) -> bool:
+        if self.is_done(key):
+            return False
+        lease = self._path(key, "lease")
+        for _ in range(2):
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    age = time.time() - lease.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if age < self.lease_seconds:
+                    return False
+                # Expired: move it aside atomically so only one worker takes it over.
+                stale = lease.with_name(f"{lease.name}.{os.getpid()}.stale")
+                try:
+                    os.replace(lease, stale)
+                except FileNotFoundError:
+                    return False
+                stale.unlink(missing_ok=True)
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.owner)
+            return not self.is_done(key)
+        return False
+
+    def complete(self, key: RunKey) -> None:
+        self._path(key, "done").touch()
+        self._path(key, "lease").unlink(missing_ok=True)
+
+    def release(self, key: RunKey) -> None:
+        self._path(key, "lease").unlink(missing_ok=True)
+
+
+class LeaseCompletingWriter:
+    """Marks leased keys done once their records are durably written."""
+
+    def __init__(self, writer: Any, lease_queue: LeaseQueue):
+        self.writer = writer
+        self.lease_queue = lease_queue
+        self._pending: List[RunKey] = []
+
+    def write(self, record: dict) -> None:
+        self.writer.write(record)
+        self._pending.append((record["benchmark"], record["agent"], record["instance_id"]))
+
+    def flush(self) -> None:
+        getattr(self.writer, "sync", self.writer.flush)()
+        for key in self._pending:
+            self.lease_queue.complete(key)
+        self._pending.clear()
+
+
+class ShardFilter:
+    """Decides which (benchmark, agent, instance_id) keys this worker runs."""
+
+    def __init__(self, num_shards: int = 1, shard_index: int = 0, lease_queue: Optional[LeaseQueue] = None):
+        if num_shards < 1 or not 0 <= shard_index < num_shards:
+            raise ValueError(f"Invalid shard {shard_index} of {num_shards}")
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.lease_queue = lease_queue
+
+    def owns(self, key: RunKey) -> bool:
+        if self.lease_queue is not None:
+            return self.lease_queue.claim(key)
+        return self.num_shards == 1 or shard_of(key, self.num_shards) == self.shard_index
+
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Callable, Optional
 
 from .base import Agent
-from .model import HFModel, GenerationConfig
+from .model import HFModel, GenerationConfig, generation_metadata
 from .types import AgentResult, TaskInstance
+from .utils import Spans
 
 
 @dataclass
@@ -24,10 +25,16 @@ class SummaryState:
 
 
 class SummarizationAgent(Agent):
-    def __init__(self, model: HFModel, config: Optional[GenerationConfig] = None):
+    def __init__(
+        self,
+        model: HFModel,
+        config: Optional[GenerationConfig] = None,
+        stop: Optional[Callable[[str], bool]] = None,
+    ):
         super().__init__(name="summarization")
         self.model = model
         self.config = config
+        self.stop = stop
         self.state = SummaryState()
 
     def _update_state(self, summary_text: str) -> None:
@@ -36,19 +43,22 @@ class SummarizationAgent(Agent):
         self.state.decisions = [summary_text]
 
     def run(self, instance: TaskInstance) -> AgentResult:
-        summary = self.state.render()
-        prompt = (
-            "You are an assistant that uses a running structured summary.\n"
-            f"Summary so far:\n{summary}\n\n"
-            f"Current input:\n{instance.input}\n\n"
-            "Respond and update the summary in your answer."
-        )
-        result = self.model.generate(prompt, self.config)
-        self._update_state(result["text"])
+        spans = Spans()
+        with spans.span("total"):
+            summary = self.state.render()
+            prompt = (
+                "You are an assistant that uses a running structured summary.\n"
+                f"Summary so far:\n{summary}\n\n"
+                f"Current input:\n{instance.input}\n\n"
+                "Respond and update the summary in your answer."
+            )
+            result = self.model.generate(prompt, self.config, stop=self.stop)
+            self._update_state(result["text"])
+        spans.add_calls([result])
         return AgentResult(
             text=result["text"],
             tokens_in=result["tokens_in"],
             tokens_out=result["tokens_out"],
             latency_ms=result["latency_ms"],
-            metadata={"agent": self.name},
+            metadata={"agent": self.name, **generation_metadata(result), **spans.metadata()},
         )
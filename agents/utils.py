@@ -1,25 +1,126 @@
 from __future__ import annotations
 
+import os
 import time
-from typing import Callable, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
 
 
 class Timer:
     def __enter__(self) -> "Timer":
-        self._start = time.time()
+        self.start_ns = time.perf_counter_ns()
+        self.elapsed_ns = 0
         self.elapsed_ms = 0
         return self
 
     def __exit__(self, exc_type, exc, tb) -> None:
-        self.elapsed_ms = int((time.time() - self._start) * 1000)
+        self.elapsed_ns = time.perf_counter_ns() - self.start_ns
+        self.elapsed_ms = self.elapsed_ns // 1_000_000
+
+
+class Spans:
+    """Named wall-clock durations in nanoseconds plus the token counts behind them.
+
+    Repeated spans with the same name accumulate, so one instance can collect
+    every model call an agent makes for a task.
+    """
+
+    def __init__(self, ns: Optional[Mapping[str, int]] = None):
+        self.ns: Dict[str, int] = dict(ns or {})
+        self.tokens: Dict[str, int] = {}
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter_ns() - start)
+
+    def add(self, name: str, ns: int) -> None:
+        self.ns[name] = self.ns.get(name, 0) + ns
+
+    def count(self, name: str, tokens: int) -> None:
+        self.tokens[name] = self.tokens.get(name, 0) + tokens
+
+    def update(self, other: "Spans") -> "Spans":
+        for name, ns in other.ns.items():
+            self.add(name, ns)
+        for name, tokens in other.tokens.items():
+            self.count(name, tokens)
+        return self
+
+    def add_calls(self, results: Iterable[Mapping]) -> "Spans":
+        # Results of one batched call share a single spans_ns dict, so each call
+        # is counted once; cache hits carry no spans.
+        seen = set()
+        for result in results:
+            ns = result.get("spans_ns")
+            if ns is None or id(ns) in seen:
+                continue
+            seen.add(id(ns))
+            for name, value in ns.items():
+                self.add(name, value)
+            for name in ("prefill", "decode"):
+                self.count(name, result.get(f"{name}_tokens", 0))
+        return self
+
+    def metadata(self) -> dict:
+        metadata: dict = {"spans_ms": {name: round(ns / 1e6, 3) for name, ns in self.ns.items()}}
+        for name, tokens in self.tokens.items():
+            if self.ns.get(name):
+                metadata[f"{name}_tokens_per_s"] = round(tokens * 1e9 / self.ns[name], 1)
+        return metadata
+
+
+_SENTENCE_END = frozenset(".!?\n")
+
+
+def chunk_by_tokens(tokenizer, text: str, budget: int) -> List[str]:
+    # Cut on token boundaries, backing off to the last sentence end in the second
+    # half of each window so chunks rarely split a sentence.
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = encoding["offset_mapping"]
+    if len(offsets) <= budget:
+        return [text]
+    chunks = []
+    start = 0
+    char_start = 0
+    while start < len(offsets):
+        end = min(start + budget, len(offsets))
+        if end < len(offsets):
+            for cut in range(end, start + budget // 2, -1):
+                token_end = offsets[cut - 1][1]
+                if token_end > 0 and text[token_end - 1] in _SENTENCE_END:
+                    end = cut
+                    break
+        char_end = offsets[end][0] if end < len(offsets) else len(text)
+        chunks.append(text[char_start:char_end])
+        char_start = char_end
+        start = end
+    return chunks
+
 
+def batched(items: Sequence[T], size: int) -> List[List[T]]:
+    size = max(1, size)
+    return [list(items[i : i + size]) for i in range(0, len(items), size)]
 
-def count_tokens(tokenizer, text: str) -> int:
-    return len(tokenizer.encode(text))
 
+@contextmanager
+def atomic_write_path(path: Path, suffix: str = ".tmp") -> Iterator[Path]:
+    """Yield a temporary sibling of ``path`` that replaces it once the block succeeds.
 
-def safe_call(func: Callable[[], Tuple[str, int, int]]) -> Tuple[str, int, int]:
+    An interrupted write therefore never leaves a half-written file under the
+    final name, which cache lookups would otherwise trust.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + suffix)
     try:
-        return func()
-    except Exception as exc:  # noqa: BLE001
-        raise RuntimeError(f"Model call failed: {exc}") from exc
+        yield tmp_path
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import math
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from .utils import atomic_write_path
+
+if TYPE_CHECKING:
+    import faiss
+
+    from .rag import RAGConfig
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "pq", "ivf_pq", "sq8", "binary")
+
+
+def default_nlist(num_vectors: int) -> int:
+    # ~4 * sqrt(N) lists, capped so every list gets at least 39 training points.
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def _pq_nbits(config: "RAGConfig", num_vectors: int) -> int:
+    # k-means needs at least 2**nbits training points per sub-quantizer.
+    return max(1, min(config.pq_nbits, int(math.log2(max(2, num_vectors)))))
+
+
+def index_signature(config: "RAGConfig") -> str:
+    if config.index_type == "flat":
+        return "flat"
+    if config.index_type == "ivf_flat":
+        return f"ivf_flat-nlist{config.nlist or 'auto'}"
+    if config.index_type == "hnsw":
+        return f"hnsw-m{config.hnsw_m}-efc{config.ef_construction}"
+    if config.index_type == "pq":
+        return f"pq-m{config.pq_m}x{config.pq_nbits}"
+    if config.index_type == "ivf_pq":
+        return f"ivf_pq-nlist{config.nlist or 'auto'}-m{config.pq_m}x{config.pq_nbits}"
+    if config.index_type == "sq8":
+        return "sq8"
+    if config.index_type == "binary":
+        return "binary"
+    raise ValueError(f"Unknown index type: {config.index_type} (expected one of {INDEX_TYPES})")
+
+
+def binarize(vectors: np.ndarray) -> np.ndarray:
+    return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+
+class EmbeddingTable:
+    """Float vectors addressed by passage id: the cached matrix plus in-memory edits.
+
+    Row ``i`` of ``base`` holds passage id ``i``; vectors of added or updated
+    passages live in ``overrides`` and removed ids are tracked in ``removed``.
+    """
+
+    def __init__(self, base: np.ndarray):
+        self.base = base
+        self.overrides: Dict[int, np.ndarray] = {}
+        self.removed: Set[int] = set()
+
+    def set(self, passage_id: int, vector: np.ndarray) -> None:
+        self.overrides[passage_id] = np.asarray(vector, dtype=np.float32)
+        self.removed.discard(passage_id)
+
+    def discard(self, passage_id: int) -> None:
+        self.overrides.pop(passage_id, None)
+        if passage_id < len(self.base):
+            self.removed.add(passage_id)
+
+    def live_ids(self) -> np.ndarray:
+        live = np.ones(len(self.base), dtype=bool)
+        live[list(self.removed)] = False
+        ids = np.concatenate([np.nonzero(live)[0], np.fromiter(self.overrides, dtype=np.int64)])
+        return np.unique(ids.astype(np.int64))
+
+    def __getitem__(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        if not self.overrides:
+            return np.asarray(self.base[ids], dtype=np.float32)
+        rows = np.empty((len(ids), self.base.shape[1]), dtype=np.float32)
+        for row, passage_id in enumerate(ids.tolist()):
+            vector = self.overrides.get(passage_id)
+            rows[row] = vector if vector is not None else self.base[passage_id]
+        return rows
+
+
+class BinaryRerankIndex:
+    """Sign-bit Hamming search over packed codes, re-ranked with float vectors.
+
+    Only the packed codes (dim / 8 bytes per passage) live in the FAISS index; the
+    float rows used for re-ranking are read from ``embeddings``, which is usually a
+    read-only memmap of the cached embedding matrix.
+    """
+
+    def __init__(
+        self,
+        binary_index: faiss.IndexBinary,
+        embeddings: Union[np.ndarray, EmbeddingTable],
+        rerank_factor: int = 4,
+    ):
+        self.binary_index = binary_index
+        self.embeddings = embeddings
+        self.rerank_factor = rerank_factor
+
+    @property
+    def ntotal(self) -> int:
+        return self.binary_index.ntotal
+
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        self.binary_index.add_with_ids(binarize(vectors), ids)
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        return self.binary_index.remove_ids(ids)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        _, candidates = self.binary_index.search(binarize(queries), k * self.rerank_factor)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, ids) in enumerate(zip(queries, candidates)):
+            ids = ids[ids >= 0]
+            if not len(ids):
+                continue
+            order = np.argsort(ids)
+            sims = np.asarray(self.embeddings[ids[order]], dtype=np.float32) @ query
+            top = np.argsort(-sims, kind="stable")[:k]
+            scores[row, : len(top)] = sims[top]
+            indices[row, : len(top)] = ids[order][top]
+        return scores, indices
+
+
+AnyIndex = Union["faiss.Index", BinaryRerankIndex]
+
+
+def _training_sample(embeddings: np.ndarray, sample_size: int, seed: int = 0) -> np.ndarray:
+    if len(embeddings) <= sample_size:
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(embeddings), size=sample_size, replace=False))
+    return np.ascontiguousarray(embeddings[rows], dtype=np.float32)
+
+
+def build_index(embeddings: np.ndarray, config: "RAGConfig") -> AnyIndex:
+    import faiss
+
+    # Every index stores passage ids (row numbers of ``embeddings``) rather than
+    # insertion positions, so passages can later be added, updated and removed.
+    num_vectors, dim = embeddings.shape
+    vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+    ids = np.arange(num_vectors, dtype=np.int64)
+    if config.index_type == "binary":
+        if dim % 8:
+            raise ValueError(f"Binary index needs a dimension divisible by 8, got {dim}")
+        binary_index = faiss.IndexBinaryIDMap(faiss.IndexBinaryFlat(dim))
+        binary_index.add_with_ids(binarize(vectors), ids)
+        return BinaryRerankIndex(binary_index, embeddings, config.binary_rerank_factor)
+
+    if config.index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif config.index_type == "ivf_flat":
+        nlist = config.nlist or default_nlist(num_vectors)
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    elif config.index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config.ef_construction
+    elif config.index_type == "pq":
+        index = faiss.IndexPQ(dim, config.pq_m, _pq_nbits(config, num_vectors), faiss.METRIC_INNER_PRODUCT)
+    elif config.index_type == "ivf_pq":
+        nlist = config.nlist or default_nlist(num_vectors)
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, nlist, config.pq_m, _pq_nbits(config, num_vectors), faiss.METRIC_INNER_PRODUCT
+        )
+    elif config.index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"Unknown index type: {config.index_type} (expected one of {INDEX_TYPES})")
+    if not index.is_trained:
+        index.train(_training_sample(embeddings, config.train_sample_size))
+    # IVF indexes store ids natively; the others keep positions that shift on
+    # removal, so they are wrapped in an id map.
+    if not isinstance(index, faiss.IndexIVF):
+        index = faiss.IndexIDMap(index)
+    index.add_with_ids(vectors, ids)
+    configure_search(index, config)
+    return index
+
+
+def base_index(index: AnyIndex) -> AnyIndex:
+    import faiss
+
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexBinaryIDMap)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def supports_removal(index: AnyIndex) -> bool:
+    return not hasattr(base_index(index), "hnsw")
+
+
+def configure_search(index: AnyIndex, config: "RAGConfig") -> AnyIndex:
+    if isinstance(index, BinaryRerankIndex):
+        index.rerank_factor = config.binary_rerank_factor
+        return index
+    inner = base_index(index)
+    if hasattr(inner, "nprobe"):
+        inner.nprobe = config.nprobe
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = config.ef_search
+    return index
+
+
+def supports_gpu(index: AnyIndex) -> bool:
+    import faiss
+
+    return isinstance(base_index(index), (faiss.IndexFlat, faiss.IndexIVFFlat))
+
+
+def index_nbytes(index: AnyIndex) -> int:
+    import faiss
+
+    if isinstance(index, BinaryRerankIndex):
+        return int(faiss.serialize_index_binary(index.binary_index).nbytes)
+    if hasattr(faiss, "GpuIndex") and isinstance(index, faiss.GpuIndex):
+        index = faiss.index_gpu_to_cpu(index)
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def write_index(index: AnyIndex, path: Path) -> None:
+    import faiss
+
+    with atomic_write_path(path) as tmp_path:
+        if isinstance(index, BinaryRerankIndex):
+            faiss.write_index_binary(index.binary_index, str(tmp_path))
+        else:
+            faiss.write_index(index, str(tmp_path))
+
+
+def read_index(path: Path, embeddings: np.ndarray, config: "RAGConfig", mmap: bool = True) -> AnyIndex:
+    import faiss
+
+    if config.index_type == "binary":
+        index = BinaryRerankIndex(faiss.read_index_binary(str(path)), embeddings)
+    elif mmap:
+        try:
+            index = faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Not every index type supports memory-mapped reads.
+            index = faiss.read_index(str(path))
+    else:
+        index = faiss.read_index(str(path))
+    return configure_search(index, config)
+
+
+def compare_with_flat(
+    index: AnyIndex,
+    embeddings: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    flat_index: Optional[faiss.Index] = None,
+    ids: Optional[np.ndarray] = None,
+) -> Dict[str, float]:
+    import faiss
+
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if flat_index is None:
+        if ids is None:
+            ids = np.arange(len(embeddings), dtype=np.int64)
+        flat_index = faiss.IndexIDMap(faiss.IndexFlatIP(queries.shape[1]))
+        flat_index.add_with_ids(np.ascontiguousarray(embeddings[ids], dtype=np.float32), ids)
+
+    start = time.perf_counter()
+    _, truth = flat_index.search(queries, k)
+    flat_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    seconds = time.perf_counter() - start
+
+    hits = 0
+    for truth_row, found_row in zip(truth, found):
+        hits += len(set(truth_row[truth_row >= 0]) & set(found_row[found_row >= 0]))
+    expected = int((truth >= 0).sum())
+    return {
+        "k": k,
+        "queries": len(queries),
+        "recall_at_k": hits / expected if expected else 0.0,
+        "qps": len(queries) / seconds if seconds > 0 else float("inf"),
+        "flat_qps": len(queries) / flat_seconds if flat_seconds > 0 else float("inf"),
+        "bytes_per_passage": index_nbytes(index) / max(1, index.ntotal),
+    }
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# Entry points that must start without loading any model or plotting stack.
+ENTRY_POINTS = [
+    "agents",
+    "eval.evaluate_runs",
+    "eval.merge_runs",
+    "eval.compare_runs",
+    "eval.bench_lcs",
+    "viz.plot_metrics",
+]
+HEAVY_MODULES = ("torch", "transformers", "sentence_transformers", "faiss", "matplotlib", "pyarrow")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Check import time of the CLI entry points with -X importtime")
+    parser.add_argument("--modules", nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--budget-ms", type=float, default=1000.0, help="Fail if an entry point imports slower")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per module; the fastest is reported")
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports to list per module")
+    return parser.parse_args()
+
+
+def measure(module: str) -> Tuple[float, Dict[str, float]]:
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    cumulative: Dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative_us, name = line.split("|", 2)
+        cumulative[name.strip()] = int(cumulative_us) / 1000
+    return cumulative.get(module, 0.0), cumulative
+
+
+def main() -> None:
+    args = parse_args()
+    failures: List[str] = []
+    print(f"{'module':<24} {'ms':>8}  slowest imports")
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.repeat)]
+        total, cumulative = min(runs, key=lambda run: run[0])
+        heavy = sorted(name for name in cumulative if name.split(".")[0] in HEAVY_MODULES and "." not in name)
+        slowest = sorted(
+            ((ms, name) for name, ms in cumulative.items() if "." not in name and not module.startswith(name)),
+            reverse=True,
+        )[: args.top]
+        print(f"{module:<24} {total:>8.1f}  " + ", ".join(f"{name} {ms:.0f}" for ms, name in slowest))
+        if heavy:
+            failures.append(f"{module} imports {', '.join(heavy)} at startup")
+        if total > args.budget_ms:
+            failures.append(f"{module} took {total:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
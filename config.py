@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Optional
 
@@ -28,11 +28,22 @@ class RunConfig:
     output: str = "runs/output.jsonl"
     seed: int = 42
     cache_dir: str = "hf_cache"
+    batch_size: int = 1
+    prefix_cache_mb: int = 0
+    generation_cache: str = ""
+    generation_cache_mb: int = 1024
+    seed_generation: bool = False
+    stop_sequences: List[str] = field(default_factory=list)
+    pipelined: bool = False
+    prefetch_depth: int = 2
+    write_queue_depth: int = 256
 
 
 @dataclass
 class EvalConfig:
     output: str = "runs/metrics.json"
+    incremental: bool = False
+    workers: int = 1
 
 
 @dataclass
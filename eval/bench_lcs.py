@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from typing import Callable, List
+
+from eval.metrics import _lcs_length, _lcs_length_dp
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare bit-parallel and dynamic-programming LCS for ROUGE-L")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[50, 200, 1000, 4000])
+    parser.add_argument("--vocab", type=int, default=500, help="Distinct tokens in the random texts")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def _best_time(fn: Callable[[List[str], List[str]], int], a: List[str], b: List[str], repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(a, b)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    args = parse_args()
+    rng = random.Random(args.seed)
+    vocab = [f"w{i}" for i in range(args.vocab)]
+    print(f"{'tokens':>8} {'dp_ms':>10} {'bitpar_ms':>10} {'speedup':>8}")
+    for length in args.lengths:
+        a = rng.choices(vocab, k=length)
+        b = rng.choices(vocab, k=length)
+        expected = _lcs_length_dp(a, b)
+        actual = _lcs_length(a, b)
+        if actual != expected:
+            raise SystemExit(f"LCS mismatch at {length} tokens: {actual} != {expected}")
+        dp = _best_time(_lcs_length_dp, a, b, args.repeats)
+        bitpar = _best_time(_lcs_length, a, b, args.repeats)
+        print(f"{length:>8} {dp * 1000:>10.2f} {bitpar * 1000:>10.2f} {dp / bitpar:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
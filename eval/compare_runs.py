@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+from pathlib import Path
+from typing import Dict, List
+
+from eval.evaluate_runs import METRIC_VERSIONS, evaluate_runs
+from eval.metric_cache import MetricCache
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Evaluate several run files and tabulate their metrics side by side")
+    parser.add_argument("inputs", nargs="+", help="Run output files (JSONL or Parquet)")
+    parser.add_argument("--metric-cache", default="runs/metric_cache.sqlite")
+    parser.add_argument(
+        "--state-dir",
+        default="runs/compare",
+        help="Per-run metrics and incremental checkpoints, so unchanged runs are not re-read",
+    )
+    parser.add_argument("--output", default=None, help="Optional CSV file for the comparison table")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=1)
+    return parser.parse_args()
+
+
+def metrics_path_for(state_dir: Path, path: Path) -> Path:
+    digest = hashlib.blake2b(str(path.resolve()).encode("utf-8"), digest_size=4).hexdigest()
+    return state_dir / f"{path.stem}-{digest}.metrics.json"
+
+
+def compare_runs(
+    inputs: List[Path],
+    state_dir: Path,
+    metric_cache: MetricCache,
+    batch_size: int = 256,
+    workers: int = 1,
+) -> List[Dict[str, object]]:
+    rows: List[Dict[str, object]] = []
+    for path in inputs:
+        metrics = evaluate_runs(
+            path,
+            metrics_path_for(state_dir, path),
+            incremental=True,
+            batch_size=batch_size,
+            workers=workers,
+            metric_cache=metric_cache,
+        )
+        for agent, values in metrics["overall"].items():
+            rows.append({"run": path.stem, "benchmark": "all", "agent": agent, **values})
+        for benchmark, agents in metrics["by_benchmark"].items():
+            for agent, values in agents.items():
+                rows.append({"run": path.stem, "benchmark": benchmark, "agent": agent, **values})
+    return rows
+
+
+def format_table(rows: List[Dict[str, object]]) -> str:
+    metrics = [metric for metric in METRIC_VERSIONS if any(metric in row for row in rows)]
+    columns = ["run", "benchmark", "agent", *metrics]
+    cells = [columns] + [
+        [str(row[c]) if c in ("run", "benchmark", "agent") else (f"{row[c]:.4f}" if c in row else "-") for c in columns]
+        for row in rows
+    ]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in cells
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    metric_cache = MetricCache(args.metric_cache)
+    rows = compare_runs(
+        [Path(p) for p in args.inputs],
+        Path(args.state_dir),
+        metric_cache,
+        batch_size=args.batch_size,
+        workers=args.workers,
+    )
+    print(format_table(rows))
+    print(f"Metric cache: {metric_cache.hits} hits, {metric_cache.misses} misses")
+    if args.output:
+        metrics = [metric for metric in METRIC_VERSIONS if any(metric in row for row in rows)]
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with output_path.open("w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["run", "benchmark", "agent", *metrics])
+            writer.writeheader()
+            writer.writerows(rows)
+    metric_cache.close()
+
+
+if __name__ == "__main__":
+    main()
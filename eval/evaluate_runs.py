@@ -2,76 +2,317 @@ from __future__ import annotations
 
 import argparse
 import json
-from collections import defaultdict
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
 
-from eval.metrics import constraint_adherence, evidence_coverage, rouge_l, semantic_similarity, token_f1
+from eval.metrics import (
+    constraint_adherence,
+    evidence_coverage,
+    rouge_l,
+    semantic_similarity_batch,
+    token_f1,
+)
+from eval.metric_cache import MetricCache
+from eval.records import fingerprint, iter_records_from
+
+EVAL_COLUMNS = ("benchmark", "agent", "task_type", "output", "reference", "evidence")
+# Bump when scoring changes so stale checkpoints are discarded.
+CHECKPOINT_VERSION = 1
+SCORE_CHUNK_SIZE = 1024
+MODEL_METRICS = {"semantic_similarity": semantic_similarity_batch}
+RECORD_METRICS = {
+    "constraint_adherence": constraint_adherence,
+    "token_f1": token_f1,
+    "rouge_l": rouge_l,
+    "evidence_coverage": evidence_coverage,
+}
+# Record field each metric compares the output with.
+METRIC_FIELDS = {
+    "constraint_adherence": "evidence",
+    "token_f1": "reference",
+    "rouge_l": "reference",
+    "semantic_similarity": "reference",
+    "evidence_coverage": "evidence",
+}
+# Bump a metric's version when its implementation changes so cached values are ignored.
+METRIC_VERSIONS = {
+    "constraint_adherence": 1,
+    "token_f1": 1,
+    "rouge_l": 1,
+    "semantic_similarity": 1,
+    "evidence_coverage": 1,
+}
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Evaluate run outputs")
     parser.add_argument("--input", default="runs/output.jsonl")
     parser.add_argument("--output", default="runs/metrics.json")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Score only records appended since the checkpoint stored next to --output",
+    )
+    parser.add_argument("--batch-size", type=int, default=256, help="Encoder batch size for model-based metrics")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes scoring the per-record metrics; results match the serial path exactly",
+    )
+    parser.add_argument("--metric-cache", default=None, help="SQLite file memoizing metric values across runs")
     return parser.parse_args()
 
 
-def evaluate_runs(input_path: Path, output_path: Path) -> dict:
-    aggregates = defaultdict(list)
-    aggregates_by_benchmark = defaultdict(list)
-
-    with input_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            record = json.loads(line)
-            task_type = record.get("task_type")
-            benchmark = record.get("benchmark", "unknown")
-            output = record["output"]
-            reference = record.get("reference")
-            evidence = record.get("evidence") or []
-
-            if task_type == "sequential_consistency":
-                adherence = constraint_adherence(output, evidence)
-                aggregates[(record["agent"], "constraint_adherence")].append(adherence)
-                aggregates_by_benchmark[(benchmark, record["agent"], "constraint_adherence")].append(
-                    adherence
-                )
-
-            if reference:
-                f1 = token_f1(output, reference)
-                aggregates[(record["agent"], "token_f1")].append(f1)
-                aggregates_by_benchmark[(benchmark, record["agent"], "token_f1")].append(f1)
-
-            if task_type == "summarization" and reference:
-                rouge = rouge_l(output, reference)
-                sim = semantic_similarity(output, reference)
-                aggregates[(record["agent"], "rouge_l")].append(rouge)
-                aggregates[(record["agent"], "semantic_similarity")].append(sim)
-                aggregates_by_benchmark[(benchmark, record["agent"], "rouge_l")].append(rouge)
-                aggregates_by_benchmark[(benchmark, record["agent"], "semantic_similarity")].append(
-                    sim
-                )
-
-            if evidence:
-                coverage = evidence_coverage(output, evidence)
-                aggregates[(record["agent"], "evidence_coverage")].append(coverage)
-                aggregates_by_benchmark[(benchmark, record["agent"], "evidence_coverage")].append(
-                    coverage
-                )
-
-    overall = {}
-    for (agent, metric), vals in aggregates.items():
-        overall.setdefault(agent, {})[metric] = sum(vals) / len(vals) if vals else 0.0
-
-    by_benchmark = {}
-    for (benchmark, agent, metric), vals in aggregates_by_benchmark.items():
-        by_benchmark.setdefault(benchmark, {}).setdefault(agent, {})[metric] = (
-            sum(vals) / len(vals) if vals else 0.0
+def applicable_metrics(record: dict) -> List[str]:
+    task_type = record.get("task_type")
+    reference = record.get("reference")
+    metrics = []
+    if task_type == "sequential_consistency":
+        metrics.append("constraint_adherence")
+    if reference:
+        metrics.append("token_f1")
+    if task_type == "summarization" and reference:
+        metrics.extend(["rouge_l", "semantic_similarity"])
+    if record.get("evidence"):
+        metrics.append("evidence_coverage")
+    return metrics
+
+
+def score_record(record: dict, metrics: Optional[List[str]] = None) -> Dict[str, float]:
+    """Compute the per-record metrics; model-based ones are left to ``fill_model_scores``."""
+    if metrics is None:
+        metrics = applicable_metrics(record)
+    output = record["output"]
+    reference = record.get("reference")
+    evidence = record.get("evidence") or []
+    scores = {}
+    for metric in metrics:
+        if metric in RECORD_METRICS:
+            compared = evidence if METRIC_FIELDS[metric] == "evidence" else reference
+            scores[metric] = RECORD_METRICS[metric](output, compared)
+    return scores
+
+
+def score_chunk(records: List[dict], todo: Optional[List[List[str]]] = None) -> List[Dict[str, float]]:
+    if todo is None:
+        return [score_record(record) for record in records]
+    return [score_record(record, metrics) for record, metrics in zip(records, todo)]
+
+
+def fill_model_scores(
+    records: List[dict], todo: List[List[str]], scores: List[Dict[str, float]], batch_size: int = 256
+) -> List[str]:
+    """Add model-based metrics to ``scores``; returns the metrics whose model was unavailable.
+
+    Those metrics score 0.0, as before, but must not be cached as real values.
+    """
+    unavailable = []
+    for metric, batch_fn in MODEL_METRICS.items():
+        rows = [i for i, metrics in enumerate(todo) if metric in metrics]
+        if not rows:
+            continue
+        values = batch_fn(
+            [records[i]["output"] for i in rows],
+            [records[i].get("reference") for i in rows],
+            batch_size=batch_size,
         )
+        if values is None:
+            unavailable.append(metric)
+            values = [0.0] * len(rows)
+        for i, value in zip(rows, values):
+            scores[i][metric] = value
+    return unavailable
+
+
+def _iter_chunks(records: Iterator[Tuple[dict, int]], size: int) -> Iterator[Tuple[List[dict], int]]:
+    chunk: List[dict] = []
+    end = 0
+    for record, end in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk, end
+            chunk = []
+    if chunk:
+        yield chunk, end
+
+
+@dataclass
+class _Chunk:
+    records: List[dict]
+    end: int
+    plan: List[List[str]]
+    todo: List[List[str]]
+    cached: List[Dict[str, float]]
+    keys: List[Dict[str, str]]
+
+
+def _plan_chunks(
+    chunks: Iterator[Tuple[List[dict], int]], metric_cache: Optional[MetricCache]
+) -> Iterator[_Chunk]:
+    for records, end in chunks:
+        plan = [applicable_metrics(record) for record in records]
+        keys: List[Dict[str, str]] = [{} for _ in records]
+        cached: List[Dict[str, float]] = [{} for _ in records]
+        if metric_cache is not None:
+            for record, metrics, record_keys in zip(records, plan, keys):
+                for metric in metrics:
+                    record_keys[metric] = MetricCache.make_key(
+                        metric, METRIC_VERSIONS[metric], record["output"], record.get(METRIC_FIELDS[metric])
+                    )
+            found = metric_cache.get_many(key for record_keys in keys for key in record_keys.values())
+            cached = [
+                {metric: found[key] for metric, key in record_keys.items() if key in found} for record_keys in keys
+            ]
+        todo = [[metric for metric in metrics if metric not in hits] for metrics, hits in zip(plan, cached)]
+        yield _Chunk(records, end, plan, todo, cached, keys)
+
+
+def _score_chunks(chunks: Iterator[_Chunk], workers: int) -> Iterator[Tuple[_Chunk, List[Dict[str, float]]]]:
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, score_chunk(chunk.records, chunk.todo)
+        return
+    # Workers return per-record scores rather than partial sums: adding them
+    # here in record order keeps the floating-point sums identical to serial.
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: Deque = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(score_chunk, chunk.records, chunk.todo)))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+class Aggregates:
+    """Running sum and count per (agent, metric) and (benchmark, agent, metric)."""
+
+    def __init__(self):
+        self.overall: Dict[Tuple[str, ...], List[float]] = {}
+        self.by_benchmark: Dict[Tuple[str, ...], List[float]] = {}
+
+    @staticmethod
+    def _add(table: dict, key: tuple, value: float) -> None:
+        stats = table.setdefault(key, [0.0, 0])
+        stats[0] += value
+        stats[1] += 1
+
+    def add(self, record: dict, scores: List[Tuple[str, float]]) -> None:
+        benchmark = record.get("benchmark", "unknown")
+        for metric, value in scores:
+            self._add(self.overall, (record["agent"], metric), value)
+            self._add(self.by_benchmark, (benchmark, record["agent"], metric), value)
+
+    def metrics(self) -> dict:
+        overall = {}
+        for (agent, metric), (total, count) in self.overall.items():
+            overall.setdefault(agent, {})[metric] = total / count if count else 0.0
+
+        by_benchmark = {}
+        for (benchmark, agent, metric), (total, count) in self.by_benchmark.items():
+            by_benchmark.setdefault(benchmark, {}).setdefault(agent, {})[metric] = (
+                total / count if count else 0.0
+            )
+        return {"overall": overall, "by_benchmark": by_benchmark}
+
+    def to_state(self) -> dict:
+        return {
+            "overall": [[*key, *stats] for key, stats in self.overall.items()],
+            "by_benchmark": [[*key, *stats] for key, stats in self.by_benchmark.items()],
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "Aggregates":
+        aggregates = cls()
+        aggregates.overall = {tuple(row[:2]): list(row[2:]) for row in state["overall"]}
+        aggregates.by_benchmark = {tuple(row[:3]): list(row[3:]) for row in state["by_benchmark"]}
+        return aggregates
+
+
+def checkpoint_path(output_path: Path) -> Path:
+    return output_path.with_name(output_path.stem + ".state.json")
+
+
+def _load_checkpoint(input_path: Path, output_path: Path) -> Tuple[Aggregates, int]:
+    path = checkpoint_path(output_path)
+    if path.exists():
+        state = json.loads(path.read_text(encoding="utf-8"))
+        position = state.get("position", 0)
+        if (
+            state.get("version") == CHECKPOINT_VERSION
+            and state.get("metric_versions") == METRIC_VERSIONS
+            and state.get("input") == str(input_path.resolve())
+            and state.get("fingerprint") == fingerprint(input_path, position)
+        ):
+            return Aggregates.from_state(state["aggregates"]), position
+        print(f"Checkpoint {path} does not match {input_path}; re-scoring from the start")
+    return Aggregates(), 0
+
+
+def _save_json(path: Path, payload: dict, **kwargs) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(payload, f, **kwargs)
+    os.replace(tmp, path)
+
+
+def evaluate_runs(
+    input_path: Path,
+    output_path: Path,
+    incremental: bool = False,
+    batch_size: int = 256,
+    workers: int = 1,
+    metric_cache: Optional[MetricCache] = None,
+) -> dict:
+    if incremental:
+        aggregates, position = _load_checkpoint(input_path, output_path)
+    else:
+        aggregates, position = Aggregates(), 0
+
+    scored = 0
+    chunks = _iter_chunks(iter_records_from(input_path, position, columns=EVAL_COLUMNS), SCORE_CHUNK_SIZE)
+    for chunk, scores in _score_chunks(_plan_chunks(chunks, metric_cache), workers):
+        # Each chunk shares one encoder pass per model-based metric, run here so
+        # the embedder is loaded once rather than in every worker.
+        unavailable = fill_model_scores(chunk.records, chunk.todo, scores, batch_size)
+        if metric_cache is not None:
+            metric_cache.put_many(
+                {
+                    keys[metric]: value
+                    for keys, values in zip(chunk.keys, scores)
+                    for metric, value in values.items()
+                    if metric not in unavailable
+                }
+            )
+        for record, metrics, hits, values in zip(chunk.records, chunk.plan, chunk.cached, scores):
+            values.update(hits)
+            aggregates.add(record, [(metric, values[metric]) for metric in metrics])
+        scored += len(chunk.records)
+        position = chunk.end
+    if incremental:
+        print(f"Scored {scored} new records from {input_path}")
 
-    aggregated = {"overall": overall, "by_benchmark": by_benchmark}
+    aggregated = aggregates.metrics()
 
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    with output_path.open("w", encoding="utf-8") as f:
-        json.dump(aggregated, f, indent=2)
+    _save_json(output_path, aggregated, indent=2)
+    if incremental:
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "metric_versions": METRIC_VERSIONS,
+            "input": str(input_path.resolve()),
+            "position": position,
+            "fingerprint": fingerprint(input_path, position),
+            "aggregates": aggregates.to_state(),
+        }
+        _save_json(checkpoint_path(output_path), state)
 
     return aggregated
 
@@ -80,7 +321,14 @@ def main() -> None:
     args = parse_args()
     input_path = Path(args.input)
     output_path = Path(args.output)
-    evaluate_runs(input_path, output_path)
+    evaluate_runs(
+        input_path,
+        output_path,
+        incremental=args.incremental,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        metric_cache=MetricCache(args.metric_cache) if args.metric_cache else None,
+    )
 
 
 if __name__ == "__main__":
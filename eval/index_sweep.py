@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import argparse
+import json
+from dataclasses import replace
+from pathlib import Path
+from typing import List
+
+import faiss
+import numpy as np
+
+from agents.embedders import acquire_embedder, resolve_device
+from agents.rag import RAGConfig
+from agents.vector_index import build_index, compare_with_flat, configure_search
+from benchmarks import get_benchmark
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compare recall@k, QPS and bytes per passage of RAG indexes against the flat index"
+    )
+    parser.add_argument("--benchmark", default="synthetic_retrieval")
+    parser.add_argument("--instances", type=int, default=20)
+    parser.add_argument("--corpus", help="Text file with one passage per line (overrides the benchmark corpus)")
+    parser.add_argument("--queries", help="Text file with one query per line (defaults to benchmark inputs)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--pq-m", type=int, default=16)
+    parser.add_argument("--rerank-factor", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--cache-dir", default="hf_cache")
+    parser.add_argument("--cpu", action="store_true", help="Encode on CPU")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the results")
+    return parser.parse_args()
+
+
+def _read_lines(path: str) -> List[str]:
+    with Path(path).open("r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def main() -> None:
+    args = parse_args()
+    base_config = RAGConfig(
+        cache_dir=args.cache_dir,
+        use_gpu=not args.cpu,
+        nlist=args.nlist,
+        hnsw_m=args.hnsw_m,
+        pq_m=args.pq_m,
+    )
+
+    benchmark = get_benchmark(args.benchmark, limit=args.instances, cache_dir=args.cache_dir)
+    instances = list(benchmark.instances())
+    corpus = _read_lines(args.corpus) if args.corpus else (benchmark.corpus() or [inst.input for inst in instances])
+    queries = _read_lines(args.queries) if args.queries else [inst.input for inst in instances]
+
+    embedder = acquire_embedder(
+        base_config.embedding_model,
+        device=resolve_device(base_config.use_gpu),
+        cache_folder=base_config.cache_dir,
+    )
+    embeddings = np.ascontiguousarray(
+        embedder.encode(corpus, normalize_embeddings=True, show_progress_bar=True), dtype=np.float32
+    )
+    query_vecs = np.ascontiguousarray(embedder.encode(queries, normalize_embeddings=True), dtype=np.float32)
+    flat = faiss.IndexFlatIP(embeddings.shape[1])
+    flat.add(embeddings)
+
+    sweeps = [
+        ("flat", None, [None]),
+        ("ivf_flat", "nprobe", args.nprobe),
+        ("hnsw", "ef_search", args.ef_search),
+        ("pq", None, [None]),
+        ("ivf_pq", "nprobe", args.nprobe),
+        ("sq8", None, [None]),
+        ("binary", "binary_rerank_factor", args.rerank_factor),
+    ]
+    results = []
+    for index_type, param, values in sweeps:
+        index = build_index(embeddings, replace(base_config, index_type=index_type))
+        for value in values:
+            label = index_type
+            if param is not None:
+                configure_search(index, replace(base_config, **{param: value}))
+                label = f"{index_type} {param}={value}"
+            stats = compare_with_flat(index, embeddings, query_vecs, args.k, flat_index=flat)
+            stats.update({"index_type": index_type})
+            if param is not None:
+                stats[param] = value
+            results.append(stats)
+            print(
+                f"{label:<32} recall@{args.k}={stats['recall_at_k']:.3f} "
+                f"qps={stats['qps']:.0f} (flat {stats['flat_qps']:.0f}) "
+                f"bytes/passage={stats['bytes_per_passage']:.1f}"
+            )
+
+    if args.output:
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with output_path.open("w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+from typing import Iterable
+
+from agents.result_store import open_result_store, record_key
+from agents.sharding import lease_output_paths, shard_output_paths
+from eval.evaluate_runs import evaluate_runs
+from eval.records import iter_records
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Merge sharded run outputs (JSONL or Parquet) into one file")
+    parser.add_argument("--inputs", nargs="*", default=[], help="Shard output files to merge")
+    parser.add_argument("--output", default="runs/output.jsonl")
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=None,
+        help="Merge the shard files derived from --output instead of listing --inputs",
+    )
+    parser.add_argument(
+        "--leased",
+        action="store_true",
+        help="Merge every lease worker's file derived from --output (runs started with --lease-dir)",
+    )
+    parser.add_argument("--metrics", default=None, help="Evaluate the merged file into this metrics JSON")
+    return parser.parse_args()
+
+
+def merge_runs(input_paths: Iterable[Path], output_path: Path) -> int:
+    with open_result_store(output_path) as store:
+        for path in input_paths:
+            if not path.exists():
+                print(f"Missing shard output: {path}")
+                continue
+            try:
+                for record in iter_records(path):
+                    if record_key(record) not in store:
+                        store.write(record)
+            except json.JSONDecodeError:
+                # A shard that crashed mid-write may end in a torn line.
+                print(f"Stopped at a malformed line in {path}")
+        return len(store)
+
+
+def main() -> None:
+    args = parse_args()
+    output_path = Path(args.output)
+    inputs = [Path(p) for p in args.inputs]
+    if args.num_shards:
+        inputs += shard_output_paths(output_path, args.num_shards)
+    if args.leased:
+        inputs += lease_output_paths(output_path)
+    count = merge_runs(inputs, output_path)
+    print(f"Merged {count} records into {output_path}")
+    if args.metrics:
+        evaluate_runs(output_path, Path(args.metrics))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable
+
+# SQLite caps the number of bound parameters per statement.
+_LOOKUP_BATCH = 500
+
+
+def _digest(value: object) -> str:
+    text = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class MetricCache:
+    """Persistent metric values keyed by (metric, version, output hash, input hash)."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS metric_values (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(metric: str, version: int, output: str, compared: object) -> str:
+        return f"{metric}:{version}:{_digest(output)}:{_digest(compared)}"
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, float]:
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, float] = {}
+        for start in range(0, len(keys), _LOOKUP_BATCH):
+            batch = keys[start : start + _LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT key, value FROM metric_values WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            found.update(rows)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, values: Dict[str, float]) -> None:
+        if values:
+            self._conn.executemany("INSERT OR REPLACE INTO metric_values (key, value) VALUES (?, ?)", values.items())
+            self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
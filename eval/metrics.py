@@ -1,10 +1,14 @@
 from __future__ import annotations
 
 import re
-from typing import Iterable, Optional
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence
 
-from sentence_transformers import SentenceTransformer
-from sentence_transformers.util import cos_sim
+import numpy as np
+
+from agents.embedders import acquire_embedder, release_embedder
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 
 def exact_match(pred: str, ref: Optional[str]) -> float:
@@ -29,6 +33,23 @@ def token_f1(pred: str, ref: Optional[str]) -> float:
 
 
 def _lcs_length(a: list[str], b: list[str]) -> int:
+    # Bit-parallel LCS (Hyyro 2004): bit j of ``v`` is cleared once b[j] is part
+    # of a longest common subsequence, so each token of ``a`` is one big-int step.
+    if not a or not b:
+        return 0
+    matches: dict[str, int] = {}
+    for j, token in enumerate(b):
+        matches[token] = matches.get(token, 0) | (1 << j)
+    mask = (1 << len(b)) - 1
+    v = mask
+    for token in a:
+        u = v & matches.get(token, 0)
+        v = ((v + u) | (v - u)) & mask
+    return len(b) - v.bit_count()
+
+
+def _lcs_length_dp(a: list[str], b: list[str]) -> int:
+    # O(n*m) reference implementation, kept to check _lcs_length against.
     if not a or not b:
         return 0
     dp = [0] * (len(b) + 1)
@@ -62,7 +83,8 @@ def rouge_l(pred: str, ref: Optional[str]) -> float:
 
 
 _BERTSCORE = None
-_EMBEDDER_CACHE: dict[str, SentenceTransformer] = {}
+# Model names this module holds one registry reference for.
+_HELD_EMBEDDERS: set[str] = set()
 
 
 def bertscore_f1(pred: str, ref: Optional[str], model_type: str = "bert-base-uncased") -> float:
@@ -80,6 +102,35 @@ def bertscore_f1(pred: str, ref: Optional[str], model_type: str = "bert-base-unc
     return float(scores["f1"][0])
 
 
+def bertscore_f1_batch(
+    preds: Sequence[str],
+    refs: Sequence[Optional[str]],
+    model_type: str = "bert-base-uncased",
+    batch_size: int = 64,
+) -> Optional[List[float]]:
+    # None, unlike a list of zeros, tells callers the scorer was unavailable.
+    scores = [0.0] * len(preds)
+    pairs = [i for i, ref in enumerate(refs) if ref is not None]
+    if not pairs:
+        return scores
+    try:
+        import evaluate  # noqa: WPS433
+    except Exception:
+        return None
+    global _BERTSCORE
+    if _BERTSCORE is None:
+        _BERTSCORE = evaluate.load("bertscore")
+    result = _BERTSCORE.compute(
+        predictions=[preds[i] for i in pairs],
+        references=[refs[i] for i in pairs],
+        model_type=model_type,
+        batch_size=batch_size,
+    )
+    for i, f1 in zip(pairs, result["f1"]):
+        scores[i] = float(f1)
+    return scores
+
+
 def evidence_coverage(pred: str, evidence: Optional[Iterable[str]]) -> float:
     if not evidence:
         return 0.0
@@ -89,6 +140,26 @@ def evidence_coverage(pred: str, evidence: Optional[Iterable[str]]) -> float:
     return covered / len(evidence_list)
 
 
+def _get_embedder(model_name: str) -> Optional[SentenceTransformer]:
+    try:
+        # Shared with RAGAgent through the process-wide registry, so a caller
+        # holding the model keeps this from loading a second copy.
+        embedder = acquire_embedder(model_name, local_files_only=True)
+    except Exception:
+        return None
+    if model_name in _HELD_EMBEDDERS:
+        release_embedder(model_name)
+    else:
+        _HELD_EMBEDDERS.add(model_name)
+    return embedder
+
+
+def release_metric_embedders() -> None:
+    """Drop the references taken by the model-based metrics."""
+    while _HELD_EMBEDDERS:
+        release_embedder(_HELD_EMBEDDERS.pop())
+
+
 def semantic_similarity(
     pred: str,
     ref: Optional[str],
@@ -96,17 +167,44 @@ def semantic_similarity(
 ) -> float:
     if ref is None:
         return 0.0
-    embedder = _EMBEDDER_CACHE.get(model_name)
+    embedder = _get_embedder(model_name)
     if embedder is None:
-        try:
-            embedder = SentenceTransformer(model_name, local_files_only=True)
-        except Exception:
-            return 0.0
-        _EMBEDDER_CACHE[model_name] = embedder
+        return 0.0
+    from sentence_transformers.util import cos_sim
+
     vectors = embedder.encode([pred, ref], normalize_embeddings=True)
     return float(cos_sim(vectors[0], vectors[1]))
 
 
+def semantic_similarity_batch(
+    preds: Sequence[str],
+    refs: Sequence[Optional[str]],
+    model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+    batch_size: int = 256,
+) -> Optional[List[float]]:
+    scores = [0.0] * len(preds)
+    pairs = [i for i, ref in enumerate(refs) if ref is not None]
+    if not pairs:
+        return scores
+    embedder = _get_embedder(model_name)
+    if embedder is None:
+        return None
+    # References repeat across agents, so each distinct text is encoded once.
+    texts = list(dict.fromkeys(text for i in pairs for text in (preds[i], refs[i])))
+    row = {text: n for n, text in enumerate(texts)}
+    vectors = np.asarray(
+        embedder.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+    )
+    sims = np.einsum(
+        "ij,ij->i",
+        vectors[[row[preds[i]] for i in pairs]],
+        vectors[[row[refs[i]] for i in pairs]],
+    )
+    for i, sim in zip(pairs, sims.tolist()):
+        scores[i] = sim
+    return scores
+
+
 def constraint_adherence(pred: str, constraints: Iterable[str]) -> float:
     constraints_list = list(constraints)
     if not constraints_list:
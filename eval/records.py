@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Tuple
+
+
+def iter_records(path: Path, columns: Optional[Sequence[str]] = None, batch_size: int = 4096) -> Iterator[dict]:
+    """Yield run records from a JSONL or Parquet output file.
+
+    With ``columns`` set, Parquet files decode only those columns; JSONL records
+    still have to be parsed whole and are trimmed afterwards.
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(str(path))
+        names = parquet_file.schema_arrow.names
+        selected = [name for name in columns if name in names] if columns is not None else names
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=selected):
+            for record in batch.to_pylist():
+                if "metadata" in record:
+                    record["metadata"] = json.loads(record["metadata"] or "{}")
+                yield record
+        return
+
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if columns is not None:
+                record = {name: record[name] for name in columns if name in record}
+            yield record
+
+
+def iter_records_from(
+    path: Path, position: int = 0, columns: Optional[Sequence[str]] = None, batch_size: int = 4096
+) -> Iterator[Tuple[dict, int]]:
+    """Yield ``(record, position after it)`` for records past ``position``.
+
+    Positions are byte offsets into JSONL files and row numbers into Parquet
+    files. A JSONL line without its trailing newline is still being written and
+    is left for the next call.
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(str(path))
+        names = parquet_file.schema_arrow.names
+        selected = [name for name in columns if name in names] if columns is not None else names
+        row = 0
+        for group in range(parquet_file.num_row_groups):
+            group_rows = parquet_file.metadata.row_group(group).num_rows
+            if row + group_rows > position:
+                skip = max(0, position - row)
+                table = parquet_file.read_row_group(group, columns=selected).slice(skip)
+                for after, record in enumerate(table.to_pylist(), start=row + skip + 1):
+                    if "metadata" in record:
+                        record["metadata"] = json.loads(record["metadata"] or "{}")
+                    yield record, after
+            row += group_rows
+        return
+
+    with path.open("rb") as f:
+        f.seek(position)
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            position += len(line)
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if columns is not None:
+                record = {name: record[name] for name in columns if name in record}
+            yield record, position
+
+
+def fingerprint(path: Path, position: int) -> str:
+    """Identify the content before ``position`` without rereading all of it."""
+    path = Path(path)
+    digest = hashlib.blake2b(digest_size=16)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        # Footer metadata (sizes and column statistics) of the covered row groups
+        # plus the keys of the last one; reruns rewrite earlier groups unchanged
+        # and only append, so the output column itself is never read.
+        parquet_file = pq.ParquetFile(str(path))
+        metadata = parquet_file.metadata
+        if metadata.num_rows < position:
+            return ""
+        start, last, covered = 0, None, 0
+        for group in range(metadata.num_row_groups):
+            if start >= position:
+                break
+            row_group = metadata.row_group(group)
+            digest.update(f"{row_group.num_rows}:{row_group.total_byte_size};".encode("utf-8"))
+            for column in range(row_group.num_columns):
+                stats = row_group.column(column).statistics
+                if stats is not None and stats.has_min_max:
+                    digest.update(repr((stats.min, stats.max)).encode("utf-8"))
+            last, covered = group, min(row_group.num_rows, position - start)
+            start += row_group.num_rows
+        if last is not None:
+            keys = parquet_file.read_row_group(last, columns=["benchmark", "agent", "instance_id"])
+            for column in keys.slice(0, covered).columns:
+                digest.update(json.dumps(column.to_pylist()).encode("utf-8"))
+        return digest.hexdigest()
+    if path.stat().st_size < position:
+        return ""
+    with path.open("rb") as f:
+        digest.update(f.read(min(position, 4096)))
+        f.seek(max(0, position - 4096))
+        digest.update(f.read(position - f.tell()))
+    return digest.hexdigest()
@@ -1,20 +1,41 @@
 from __future__ import annotations
 
 import argparse
-import json
 from pathlib import Path
+from typing import Iterator
 
 from agents import (
     HFModel,
     LongContextAgent,
+    PrefixCache,
     RAGAgent,
     RAGConfig,
     SummarizationAgent,
     SequencedMultiAgent,
 )
+from agents.embedders import held_embedder, resolve_device
+from agents.generation_cache import GenerationCache
+from agents.model import GenerationConfig, stop_at
+from agents.rag import RETRIEVAL_MODES
+from agents.result_store import open_result_store
+from agents.runner import WorkUnit, run_units
+from agents.sharding import (
+    LeaseCompletingWriter,
+    LeaseQueue,
+    ShardFilter,
+    check_lease_output,
+    lease_output_path,
+    lease_output_paths,
+    shard_output_path,
+    shard_output_paths,
+)
+from agents.utils import batched
+from agents.vector_index import INDEX_TYPES
 from benchmarks import get_benchmark
 from config import load_config
 from eval.evaluate_runs import evaluate_runs
+from eval.merge_runs import merge_runs
+from eval.metrics import release_metric_embedders
 from viz.plot_metrics import plot_metrics
 
 
@@ -26,6 +47,69 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Force RAG embeddings/indexing to run on CPU",
     )
+    parser.add_argument(
+        "--rag-index",
+        default="flat",
+        choices=INDEX_TYPES,
+        help="FAISS index type for RAG retrieval",
+    )
+    parser.add_argument(
+        "--sequenced-parallel",
+        action="store_true",
+        help="Decode the sequenced agent's two worker prompts concurrently",
+    )
+    parser.add_argument(
+        "--sequenced-chunk-tokens",
+        type=int,
+        default=None,
+        help="Token budget per chunk; enables the sequenced agent's map-reduce mode",
+    )
+    parser.add_argument(
+        "--sequenced-fan-in",
+        type=int,
+        default=2,
+        help="Analyses merged per coordinator call in map-reduce mode",
+    )
+    parser.add_argument(
+        "--sequenced-max-batch-size",
+        type=int,
+        default=8,
+        help="Most prompts the sequenced agent sends in one generate call (0 for no limit)",
+    )
+    parser.add_argument(
+        "--rag-retrieval",
+        default="dense",
+        choices=RETRIEVAL_MODES,
+        help="RAG retrieval mode: dense FAISS search, BM25 only, or BM25 shortlist with dense rerank",
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Split (benchmark, agent, instance) work units across this many workers",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=0,
+        help="Which shard this worker runs; also names its output file",
+    )
+    parser.add_argument(
+        "--lease-dir",
+        default=None,
+        help="Shared directory of lease files; workers claim units dynamically instead of by hash",
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=1800.0,
+        help="Seconds after which another worker may take over an unfinished lease",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the shard outputs (every lease worker's file with --lease-dir), then evaluate and plot",
+    )
     return parser.parse_args()
 
 
@@ -33,16 +117,64 @@ def load_corpus(instances) -> list[str]:
     return [inst.input for inst in instances]
 
 
+def evaluate_and_plot(cfg, output_path: Path) -> None:
+    metrics_path = Path(cfg.eval.output)
+    evaluate_runs(output_path, metrics_path, incremental=cfg.eval.incremental, workers=cfg.eval.workers)
+
+    output_dir = Path(cfg.viz.output_dir)
+    plot_metrics(metrics_path, output_dir)
+
+
 def main() -> None:
     args = parse_args()
     cfg = load_config(args.config)
 
     output_path = Path(cfg.run.output)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+    sharded = args.num_shards > 1 or args.lease_dir is not None
+    if args.merge:
+        if args.lease_dir is not None:
+            inputs = lease_output_paths(output_path)
+        else:
+            inputs = shard_output_paths(output_path, args.num_shards)
+        merge_runs(inputs, output_path)
+        evaluate_and_plot(cfg, output_path)
+        return
+
+    if args.lease_dir:
+        check_lease_output(output_path)
+    lease_queue = LeaseQueue(Path(args.lease_dir), lease_seconds=args.lease_timeout) if args.lease_dir else None
+    shard_filter = ShardFilter(args.num_shards, args.shard_index, lease_queue)
+    if lease_queue is not None:
+        run_path = lease_output_path(output_path, lease_queue.owner)
+    elif sharded:
+        run_path = shard_output_path(output_path, args.shard_index, args.num_shards)
+    else:
+        run_path = output_path
+    run_path.parent.mkdir(parents=True, exist_ok=True)
 
-    model = HFModel(cfg.model.model_id, load_in_4bit=cfg.model.load_in_4bit)
+    prefix_cache = None
+    if cfg.run.prefix_cache_mb > 0:
+        prefix_cache = PrefixCache(max_bytes=cfg.run.prefix_cache_mb << 20)
+    generation_cache = None
+    if cfg.run.generation_cache:
+        generation_cache = GenerationCache(cfg.run.generation_cache, max_bytes=cfg.run.generation_cache_mb << 20)
+    model = HFModel(
+        cfg.model.model_id,
+        load_in_4bit=cfg.model.load_in_4bit,
+        prefix_cache=prefix_cache,
+        generation_cache=generation_cache,
+    )
+    gen_config = GenerationConfig(seed=cfg.run.seed if cfg.run.seed_generation else None)
+    stop = stop_at(cfg.run.stop_sequences) if cfg.run.stop_sequences else None
+
+    rag_config = RAGConfig(
+        cache_dir=cfg.run.cache_dir,
+        use_gpu=not args.rag_cpu,
+        index_type=args.rag_index,
+        retrieval_mode=args.rag_retrieval,
+    )
 
-    with output_path.open("w", encoding="utf-8") as f:
+    def work_units() -> Iterator[WorkUnit]:
         for bench_cfg in cfg.benchmarks:
             benchmark = get_benchmark(
                 bench_cfg.name,
@@ -51,36 +183,53 @@ def main() -> None:
             )
             instances = list(benchmark.instances())
             corpus = benchmark.corpus() or load_corpus(instances)
-            rag_config = RAGConfig(cache_dir=cfg.run.cache_dir, use_gpu=not args.rag_cpu)
             agents = [
-                LongContextAgent(model),
-                RAGAgent(model, corpus=corpus, rag_config=rag_config),
-                SummarizationAgent(model),
-                SequencedMultiAgent(model, model, model),
+                LongContextAgent(model, gen_config, stop=stop),
+                RAGAgent(model, corpus=corpus, rag_config=rag_config, gen_config=gen_config, stop=stop),
+                SummarizationAgent(model, gen_config, stop=stop),
+                SequencedMultiAgent(
+                    model,
+                    model,
+                    model,
+                    gen_config,
+                    parallel=args.sequenced_parallel,
+                    chunk_tokens=args.sequenced_chunk_tokens,
+                    fan_in=args.sequenced_fan_in,
+                    max_batch_size=args.sequenced_max_batch_size or None,
+                ),
             ]
-            for instance in instances:
+            try:
+                for chunk in batched(instances, cfg.run.batch_size):
+                    for agent in agents:
+                        owned = [inst for inst in chunk if shard_filter.owns((benchmark.name, agent.name, inst.id))]
+                        if owned:
+                            yield WorkUnit(benchmark.name, agent, owned)
+            finally:
                 for agent in agents:
-                    result = agent.run(instance)
-                    record = {
-                        "benchmark": benchmark.name,
-                        "agent": agent.name,
-                        "instance_id": instance.id,
-                        "task_type": instance.task_type,
-                        "output": result.text,
-                        "reference": instance.reference,
-                        "evidence": instance.evidence,
-                        "tokens_in": result.tokens_in,
-                        "tokens_out": result.tokens_out,
-                        "latency_ms": result.latency_ms,
-                        "metadata": result.metadata,
-                    }
-                    f.write(json.dumps(record) + "\n")
+                    agent.close()
 
-    metrics_path = Path(cfg.eval.output)
-    evaluate_runs(output_path, metrics_path)
+    embedder_hold = held_embedder(
+        rag_config.embedding_model, resolve_device(rag_config.use_gpu), rag_config.cache_dir
+    )
+    with embedder_hold:
+        with open_result_store(run_path) as store:
+            writer = LeaseCompletingWriter(store, lease_queue) if lease_queue is not None else store
+            stats = run_units(
+                work_units(),
+                writer,
+                pipelined=cfg.run.pipelined,
+                prefetch_depth=cfg.run.prefetch_depth,
+                write_queue_depth=cfg.run.write_queue_depth,
+            )
+        print(f"Stage timings: {stats.summary()}")
 
-    output_dir = Path(cfg.viz.output_dir)
-    plot_metrics(metrics_path, output_dir)
+        if sharded:
+            print(f"Wrote shard output {run_path}; rerun with --merge once all shards have finished.")
+            return
+        try:
+            evaluate_and_plot(cfg, output_path)
+        finally:
+            release_metric_embedders()
 
 
 if __name__ == "__main__":
@@ -1,25 +1,45 @@
 from __future__ import annotations
 
 import argparse
-import json
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 
 from agents import (
     HFModel,
     LongContextAgent,
+    PrefixCache,
     RAGAgent,
     RAGConfig,
     SummarizationAgent,
     SequencedMultiAgent,
 )
+from agents.embedders import held_embedder, resolve_device
+from agents.generation_cache import GenerationCache
+from agents.model import GenerationConfig, stop_at
+from agents.rag import RETRIEVAL_MODES
+from agents.result_store import open_result_store
+from agents.runner import WorkUnit, run_units
+from agents.sharding import (
+    LeaseCompletingWriter,
+    LeaseQueue,
+    ShardFilter,
+    check_lease_output,
+    lease_output_path,
+    shard_output_path,
+)
+from agents.utils import batched
+from agents.vector_index import INDEX_TYPES
 from benchmarks import get_benchmark
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Run agent benchmarks")
     parser.add_argument("--model-id", default="Qwen/Qwen3-4B", help="HF model id")
-    parser.add_argument("--output", default="runs/output.jsonl")
+    parser.add_argument(
+        "--output",
+        default="runs/output.jsonl",
+        help="Run records file; a .parquet suffix writes zstd-compressed Parquet (needs pyarrow)",
+    )
     parser.add_argument("--instances", type=int, default=10)
     parser.add_argument(
         "--benchmarks",
@@ -33,6 +53,119 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Force RAG embeddings/indexing to run on CPU",
     )
+    parser.add_argument(
+        "--rag-index",
+        default="flat",
+        choices=INDEX_TYPES,
+        help="FAISS index type for RAG retrieval",
+    )
+    parser.add_argument(
+        "--sequenced-parallel",
+        action="store_true",
+        help="Decode the sequenced agent's two worker prompts concurrently",
+    )
+    parser.add_argument(
+        "--sequenced-chunk-tokens",
+        type=int,
+        default=None,
+        help="Token budget per chunk; enables the sequenced agent's map-reduce mode",
+    )
+    parser.add_argument(
+        "--sequenced-fan-in",
+        type=int,
+        default=2,
+        help="Analyses merged per coordinator call in map-reduce mode",
+    )
+    parser.add_argument(
+        "--sequenced-max-batch-size",
+        type=int,
+        default=8,
+        help="Most prompts the sequenced agent sends in one generate call (0 for no limit)",
+    )
+    parser.add_argument(
+        "--rag-retrieval",
+        default="dense",
+        choices=RETRIEVAL_MODES,
+        help="RAG retrieval mode: dense FAISS search, BM25 only, or BM25 shortlist with dense rerank",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of instances each agent decodes together in one batched generate call",
+    )
+    parser.add_argument(
+        "--prefix-cache-mb",
+        type=int,
+        default=0,
+        help="Memory cap for reusing KV caches of shared prompt prefixes (0 disables)",
+    )
+    parser.add_argument(
+        "--generation-cache",
+        default=None,
+        help="SQLite file caching deterministic or seeded generations across runs",
+    )
+    parser.add_argument(
+        "--generation-cache-mb",
+        type=int,
+        default=1024,
+        help="Size cap for the generation cache; least recently used entries are evicted",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed sampled generations so they are reproducible and cacheable",
+    )
+    parser.add_argument(
+        "--stop-sequences",
+        nargs="+",
+        default=None,
+        help="Stream single-answer agents and stop generating once any of these strings appears",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Prepare the next batch (retrieval, prompt building) and write results while the current batch generates",
+    )
+    parser.add_argument(
+        "--prefetch-depth",
+        type=int,
+        default=2,
+        help="Prepared batches queued ahead of generation in pipelined mode",
+    )
+    parser.add_argument(
+        "--write-queue-depth",
+        type=int,
+        default=256,
+        help="Records buffered for the background writer in pipelined mode",
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Split (benchmark, agent, instance) work units across this many workers",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=0,
+        help="Which shard this worker runs; also names its output file",
+    )
+    parser.add_argument(
+        "--lease-dir",
+        default=None,
+        help=(
+            "Shared directory of lease files; workers claim units dynamically instead of by hash "
+            "and each writes <output>.lease-<host_pid>"
+        ),
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=1800.0,
+        help="Seconds after which another worker may take over an unfinished lease",
+    )
     parser.add_argument(
         "--resume",
         action="store_true",
@@ -48,19 +181,42 @@ def load_corpus(instances) -> List[str]:
 def main() -> None:
     args = parse_args()
     output_path = Path(args.output)
+    if args.lease_dir:
+        check_lease_output(output_path)
+    lease_queue = LeaseQueue(Path(args.lease_dir), lease_seconds=args.lease_timeout) if args.lease_dir else None
+    shard_filter = ShardFilter(args.num_shards, args.shard_index, lease_queue)
+    if lease_queue is not None:
+        output_path = lease_output_path(output_path, lease_queue.owner)
+    elif args.num_shards > 1:
+        output_path = shard_output_path(output_path, args.shard_index, args.num_shards)
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    seen = set()
-    if args.resume and output_path.exists():
-        with output_path.open("r", encoding="utf-8") as f:
-            for line in f:
-                record = json.loads(line)
-                key = (record.get("benchmark"), record.get("agent"), record.get("instance_id"))
-                seen.add(key)
+    store = open_result_store(output_path, resume=args.resume)
+    seen = set(store.seen)
+    if seen:
+        print(f"Resuming: {len(seen)} records already in {output_path}")
+
+    prefix_cache = PrefixCache(max_bytes=args.prefix_cache_mb << 20) if args.prefix_cache_mb > 0 else None
+    generation_cache = None
+    if args.generation_cache:
+        generation_cache = GenerationCache(args.generation_cache, max_bytes=args.generation_cache_mb << 20)
+    model = HFModel(
+        args.model_id,
+        load_in_4bit=True,
+        prefix_cache=prefix_cache,
+        generation_cache=generation_cache,
+    )
+    gen_config = GenerationConfig(seed=args.seed)
+    stop = stop_at(args.stop_sequences) if args.stop_sequences else None
+
+    rag_config = RAGConfig(
+        cache_dir=args.cache_dir,
+        use_gpu=not args.rag_cpu,
+        index_type=args.rag_index,
+        retrieval_mode=args.rag_retrieval,
+    )
 
-    mode = "a" if args.resume else "w"
-    with output_path.open(mode, encoding="utf-8") as f:
-        model = HFModel(args.model_id, load_in_4bit=True)
+    def work_units() -> Iterator[WorkUnit]:
         for bench_name in args.benchmarks:
             try:
                 benchmark = get_benchmark(bench_name, limit=args.instances, cache_dir=args.cache_dir)
@@ -70,34 +226,49 @@ def main() -> None:
             instances = list(benchmark.instances())
             corpus = benchmark.corpus() or load_corpus(instances)
             print(f"Running benchmark: {benchmark.name} ({len(instances)} instances)")
-            rag_config = RAGConfig(cache_dir=args.cache_dir, use_gpu=not args.rag_cpu)
             agents = [
-                LongContextAgent(model),
-                RAGAgent(model, corpus=corpus, rag_config=rag_config),
-                SummarizationAgent(model),
-                SequencedMultiAgent(model, model, model),
+                LongContextAgent(model, gen_config, stop=stop),
+                RAGAgent(model, corpus=corpus, rag_config=rag_config, gen_config=gen_config, stop=stop),
+                SummarizationAgent(model, gen_config, stop=stop),
+                SequencedMultiAgent(
+                    model,
+                    model,
+                    model,
+                    gen_config,
+                    parallel=args.sequenced_parallel,
+                    chunk_tokens=args.sequenced_chunk_tokens,
+                    fan_in=args.sequenced_fan_in,
+                    max_batch_size=args.sequenced_max_batch_size or None,
+                ),
             ]
-            for instance in instances:
+            try:
+                for chunk in batched(instances, args.batch_size):
+                    for agent in agents:
+                        pending = [
+                            instance
+                            for instance in chunk
+                            if (benchmark.name, agent.name, instance.id) not in seen
+                            and shard_filter.owns((benchmark.name, agent.name, instance.id))
+                        ]
+                        if pending:
+                            yield WorkUnit(benchmark.name, agent, pending)
+            finally:
                 for agent in agents:
-                    key = (benchmark.name, agent.name, instance.id)
-                    if args.resume and key in seen:
-                        continue
-                    print(f"  Agent: {agent.name} | Instance: {instance.id}")
-                    result = agent.run(instance)
-                    record = {
-                        "benchmark": benchmark.name,
-                        "agent": agent.name,
-                        "instance_id": instance.id,
-                        "task_type": instance.task_type,
-                        "output": result.text,
-                        "reference": instance.reference,
-                        "evidence": instance.evidence,
-                        "tokens_in": result.tokens_in,
-                        "tokens_out": result.tokens_out,
-                        "latency_ms": result.latency_ms,
-                        "metadata": result.metadata,
-                    }
-                    f.write(json.dumps(record) + "\n")
+                    agent.close()
+
+    embedder_hold = held_embedder(
+        rag_config.embedding_model, resolve_device(rag_config.use_gpu), rag_config.cache_dir
+    )
+    with embedder_hold, store:
+        writer = LeaseCompletingWriter(store, lease_queue) if lease_queue is not None else store
+        stats = run_units(
+            work_units(),
+            writer,
+            pipelined=args.pipelined,
+            prefetch_depth=args.prefetch_depth,
+            write_queue_depth=args.write_queue_depth,
+        )
+    print(f"Stage timings: {stats.summary()}")
 
 
 if __name__ == "__main__":
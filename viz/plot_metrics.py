@@ -4,8 +4,6 @@ import argparse
 import json
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-
 METRIC_LABELS = {
     "constraint_adherence": "Constraint Adherence",
     "evidence_coverage": "Evidence Coverage",
@@ -43,6 +41,8 @@ def _order_agents(values: dict) -> list:
 
 
 def _plot_metric(values: dict, metric: str, title: str, output_path: Path) -> None:
+    import matplotlib.pyplot as plt
+
     agents = _order_agents(values)
     vals = [values[a] for a in agents]
     colors = [AGENT_COLORS.get(a, "#2E86AB") for a in agents]